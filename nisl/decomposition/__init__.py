@@ -2,4 +2,4 @@
 The :mod:`nisl.decomposition` module includes a subject level
 variant of the ICA called Canonnical ICA.
 """
-from canica import CanICA
+from canica import CanICA, select_n_components
@@ -4,33 +4,323 @@ CanICA
 
 # Author: ALexandre Abraham, Gael Varoquaux,
 # License: BSD 3 clause
-import copy
+import itertools
+import os
+import shutil
+import tempfile
 
 import numpy as np
-from scipy import linalg, stats
+from scipy import linalg, spatial, stats
+from scipy.cluster import hierarchy
 
-from sklearn.base import TransformerMixin
+from sklearn.base import TransformerMixin, clone
 from sklearn.decomposition import fastica
-from sklearn.externals.joblib import Memory, Parallel, delayed
+from sklearn.externals.joblib import Memory, Parallel, delayed, cpu_count
 from sklearn.utils import check_random_state
-from sklearn.utils.extmath import randomized_svd
 
-from .decomposition_model import DecompositionModel
+from .decomposition_model import DecompositionModel, _maps_cholesky
+from ..utils import _dump_shared, _load_shared
 
 
-def _subject_pca(subject_data, n_components, mem):
-    """ Warning: modifies subject_data inplace
+def _leading_eigh(gram, n_components):
+    """ Return the n_components largest eigenvalues of the symmetric matrix
+        gram, in decreasing order, and the corresponding eigenvectors.
+
+        The eigendecomposition is done in double precision, whatever the
+        dtype of gram.
+    """
+    gram = np.asarray(gram, dtype=np.float64)
+    size = len(gram)
+    eigvals, eigvecs = linalg.eigh(gram, eigvals=(size - n_components,
+                                                  size - 1))
+    # eigh returns the eigenvalues in increasing order
+    return eigvals[::-1], eigvecs[:, ::-1]
+
+
+def _truncated_pca(data, n_components):
+    """ Return the n_components leading left singular vectors of data.T,
+        where data is a (n_samples, n_features) array: an array of shape
+        (n_features, n_components), of the dtype of data.
+
+        Only the requested components are computed, from the
+        eigendecomposition of the smallest of the two Gram matrices.
+    """
+    n_samples, n_features = data.shape
+    n_components = min(n_components, n_samples, n_features)
+    if n_samples > n_features:
+        return _leading_eigh(np.dot(data.T, data),
+                             n_components)[1].astype(data.dtype)
+    eigvals, eigvecs = _leading_eigh(np.dot(data, data.T), n_components)
+    singular_values = np.sqrt(np.maximum(eigvals, 0))
+    singular_values[singular_values == 0] = 1
+    eigvecs /= singular_values
+    return np.dot(data.T, eigvecs.astype(data.dtype))
+
+
+def _standardized_blocks(subject_data, block_size, dtype=np.float64):
+    """ Iterate over the standardized column blocks of subject_data.
+
+        Yields (slice, block) pairs. The blocks, of the given dtype, are
+        written in the same scratch buffer, and are only valid until the
+        next iteration. The mean and standard deviation are accumulated in
+        double precision.
     """
-    subject_data -= subject_data.mean(axis=0)
-    std = subject_data.std(axis=0)
+    n_samples, n_features = subject_data.shape
+    mean = np.empty(n_features)
+    std = np.empty(n_features)
+    for start in range(0, n_features, block_size):
+        block = subject_data[:, start:start + block_size]
+        mean[start:start + block_size] = block.mean(axis=0, dtype=np.float64)
+        std[start:start + block_size] = block.std(axis=0, dtype=np.float64)
     std[std == 0] = 1
-    subject_data /= std
-    subject_data = subject_data.T
-    subject_data = mem.cache(linalg.svd)(subject_data,
-                                         full_matrices=False)[0]
-    # We copy here to avoid keeping a reference on the big array
-    subject_data = subject_data[:, :n_components].copy()
-    return subject_data
+    buffer = np.empty((n_samples, min(block_size, n_features)), dtype=dtype)
+    for start in range(0, n_features, block_size):
+        columns = slice(start, min(start + block_size, n_features))
+        block = buffer[:, :columns.stop - start]
+        np.subtract(subject_data[:, columns], mean[columns], out=block)
+        block /= std[columns]
+        yield columns, block
+
+
+def _standardized_pca(subject_data, n_components, block_size=1000,
+                      dtype=np.float64):
+    """ Truncated PCA of subject_data, standardized column by column. See
+        _truncated_pca.
+
+        subject_data is not modified: the standardized data is computed in
+        column blocks of block_size columns, so that the memory used in
+        addition to the data is bounded. The blocks and the components are
+        of the given dtype, the Gram matrix of the blocks is accumulated in
+        double precision.
+    """
+    n_samples, n_features = subject_data.shape
+    n_components = min(n_components, n_samples, n_features)
+    if n_samples > n_features:
+        # Few features: standardizing a copy is cheap
+        data = np.empty((n_samples, n_features), dtype=dtype)
+        for columns, block in _standardized_blocks(subject_data,
+                                                   block_size, dtype):
+            data[:, columns] = block
+        return _truncated_pca(data, n_components)
+    gram = np.zeros((n_samples, n_samples))
+    for _, block in _standardized_blocks(subject_data, block_size, dtype):
+        gram += np.dot(block, block.T)
+    eigvals, eigvecs = _leading_eigh(gram, n_components)
+    del gram
+    singular_values = np.sqrt(np.maximum(eigvals, 0))
+    singular_values[singular_values == 0] = 1
+    eigvecs /= singular_values
+    eigvecs = eigvecs.astype(dtype)
+    components = np.empty((n_features, n_components), dtype=dtype)
+    for columns, block in _standardized_blocks(subject_data, block_size,
+                                               dtype):
+        components[columns] = np.dot(block.T, eigvecs)
+    return components
+
+
+def _subject_pca(subject_data, n_components, mem, block_size=1000,
+                 dtype=np.float64):
+    """ Return the n_components leading principal components, in voxel
+        space, of the subject data standardized over time.
+
+        subject_data is not modified, and can be a memory-mapped array:
+        it is read in blocks of block_size voxels. The components are
+        computed in the given dtype. Only the components are cached.
+    """
+    return mem.cache(_standardized_pca, ignore=['block_size'])(
+        subject_data, n_components, block_size=block_size, dtype=dtype)
+
+
+def _merge_components(components, singular_values, new_components,
+                      n_components):
+    """ Fold new components in a truncated SVD of a group of components.
+
+    Parameters
+    ----------
+    components: array of shape (n_features, k) or None
+        Left singular vectors of the components seen so far, or None if
+        no component was seen yet.
+
+    singular_values: array of shape (k, ) or None
+        Corresponding singular values.
+
+    new_components: array of shape (n_features, n_new)
+        Components to append to the group.
+
+    n_components: int
+        Number of singular vectors to keep.
+
+    Returns
+    -------
+    components, singular_values: the truncated SVD of the concatenation of
+        the components seen so far and new_components. The components are
+        of the dtype of new_components.
+    """
+    dtype = new_components.dtype
+    if components is None:
+        group = new_components
+    else:
+        group = np.hstack((components * singular_values.astype(dtype),
+                           new_components))
+    n_components = min(n_components, group.shape[1])
+    eigvals, eigvecs = _leading_eigh(np.dot(group.T, group), n_components)
+    singular_values = np.sqrt(np.maximum(eigvals, 0))
+    scale = singular_values.copy()
+    scale[scale == 0] = 1
+    eigvecs /= scale
+    return np.dot(group, eigvecs.astype(dtype)), singular_values
+
+
+def _fastica_run(group_maps, seed):
+    """ Run FastICA on the group maps, or on the file in which they have
+        been dumped by _dump_shared: (n_components, n_features) array.
+    """
+    group_maps = _load_shared(group_maps)
+    return fastica(group_maps, whiten=False, fun='cube',
+                   random_state=seed)[2].T
+
+
+def _icasso(estimates, n_clusters):
+    """ Cluster the components estimated by several ICA runs, as in ICASSO.
+
+    The components are clustered by average linkage on the absolute value
+    of their correlation.
+
+    Parameters
+    ----------
+    estimates: array of shape (n_estimates, n_features)
+        The components of all the runs.
+
+    n_clusters: int
+        Number of clusters.
+
+    Returns
+    -------
+    maps: array of shape (n_clusters, n_features)
+        Centrotype of each cluster: the estimate most similar to the other
+        estimates of the cluster.
+
+    stability: array of shape (n_clusters, )
+        Stability index of each cluster: the mean similarity between
+        distinct estimates of the cluster minus the mean similarity to the
+        other clusters. A cluster of a single estimate has no support, and
+        its within-cluster similarity is 0.
+    """
+    similarity = np.abs(np.corrcoef(estimates))
+    distance = np.clip(1 - similarity, 0, 1)
+    tree = hierarchy.linkage(spatial.distance.squareform(distance,
+                                                         checks=False),
+                             method='average')
+    labels = hierarchy.fcluster(tree, n_clusters, criterion='maxclust')
+    maps = list()
+    stability = list()
+    for label in np.unique(labels):
+        inside = labels == label
+        outside = np.logical_not(inside)
+        within = similarity[inside][:, inside]
+        n_inside = len(within)
+        index = 0.
+        if n_inside > 1:
+            # The similarity of an estimate with itself does not count
+            index = ((within.sum() - np.trace(within))
+                     / (n_inside * (n_inside - 1)))
+        if outside.any():
+            index -= similarity[inside][:, outside].mean()
+        stability.append(index)
+        maps.append(estimates[inside][np.argmax(within.sum(axis=1))])
+    return np.array(maps), np.array(stability)
+
+
+def _update_group_pcas(estimators, data, memory, n_jobs=1, verbose=0):
+    """ Fold the PCA of each subject of data in the group reduction of
+        each estimator.
+
+        The PCA of a subject is computed once, with the largest
+        n_components of the estimators, and its leading columns are used
+        for the estimators with fewer components.
+    """
+    n_components = max(estimator.n_components for estimator in estimators)
+    groups = [(getattr(estimator, 'group_components_', None),
+               getattr(estimator, 'group_singular_values_', None))
+              for estimator in estimators]
+    n_subjects = getattr(estimators[0], 'n_subjects_', 0)
+    if n_jobs < 0:
+        n_jobs = cpu_count() + 1 + n_jobs
+    data = iter(data)
+    while True:
+        # Only n_jobs subject PCAs are held in memory at a time
+        chunk = list(itertools.islice(data, max(n_jobs, 1)))
+        if not chunk:
+            break
+        pcas = Parallel(n_jobs=n_jobs, verbose=verbose)(
+            delayed(_subject_pca)(subject_data, n_components=n_components,
+                                  mem=memory, dtype=estimators[0].dtype)
+            for subject_data in chunk)
+        for pca in pcas:
+            for i, estimator in enumerate(estimators):
+                # The search on the number of components needs up to
+                # 3 * n_components group components
+                groups[i] = _merge_components(
+                    groups[i][0], groups[i][1],
+                    pca[:, :estimator.n_components],
+                    3 * estimator.n_components)
+        n_subjects += len(chunk)
+    for estimator, (components, singular_values) in zip(estimators, groups):
+        estimator.group_components_ = components
+        estimator.group_singular_values_ = singular_values
+        estimator.n_subjects_ = n_subjects
+
+
+def _results_memmap(store, name, dtype, shape, start=0, mode='r+'):
+    """ Memory-map the block of the given shape, starting at element start,
+        of a file of results of dual_regression.
+    """
+    return np.memmap(os.path.join(store, '%s.dat' % name), dtype=dtype,
+                     mode=mode, offset=start * np.dtype(dtype).itemsize,
+                     shape=shape)
+
+
+def _grow_file(filename, n_bytes):
+    """ Extend the file to n_bytes, so that it can be memory-mapped.
+    """
+    if n_bytes > os.path.getsize(filename):
+        with open(filename, 'r+b') as f:
+            f.seek(n_bytes - 1)
+            f.write('\0')
+
+
+def _dual_regression(maps, maps_cholesky, subject_data, store=None,
+                     index=0, sample_offset=0):
+    """ Dual regression of the maps on the data of one subject.
+
+        maps is a (n_components, n_features) array, or the file in which
+        it has been dumped by _dump_shared, and maps_cholesky its
+        factorization returned by _maps_cholesky. If store is given, the
+        results are written in the files of results of this directory,
+        the time courses from the sample sample_offset and the maps at
+        the subject index, and None is returned.
+    """
+    maps = _load_shared(maps)
+    # Time courses of the group maps
+    timecourses = linalg.cho_solve(maps_cholesky,
+                                   np.dot(maps, subject_data.T))
+    # Subject maps of the time courses, with the same regularisation
+    timecourses = timecourses.astype(maps.dtype)
+    subject_maps = linalg.cho_solve(_maps_cholesky(timecourses),
+                                    np.dot(timecourses, subject_data))
+    timecourses = timecourses.T
+    subject_maps = subject_maps.astype(maps.dtype)
+    if store is None:
+        return timecourses, subject_maps
+    for name, result, start in [
+            ('timecourses', timecourses, sample_offset * timecourses.shape[1]),
+            ('maps', subject_maps, index * subject_maps.size)]:
+        if result.size:
+            stored = _results_memmap(store, name, result.dtype, result.shape,
+                                     start=start)
+            stored[...] = result
+            stored.flush()
+            del stored
 
 
 class CanICA(DecompositionModel, TransformerMixin):
@@ -60,7 +350,37 @@ class CanICA(DecompositionModel, TransformerMixin):
     random_state: int or RandomState
         Pseudo number generator state used for random sampling.
 
+    n_init: int, optional
+        Number of FastICA runs with different initializations. If larger
+        than 1, the runs are done in parallel on n_jobs CPUs, their
+        components are clustered as in ICASSO, and the centrotypes of the
+        n_components most stable clusters are returned. With kurtosis_thr,
+        the kurtosis search sets the number of group components of the
+        runs, and the centrotypes above the threshold are kept first.
 
+    dtype: numpy dtype, optional
+        Floating point type of the subject PCAs, the group components and
+        the maps. With np.float32, the data, such as the output of
+        apply_mask, is never upcast, and the memory used is halved. The
+        Gram matrices and the residuals are accumulated in double precision
+        whatever the dtype.
+
+    Attributes
+    ----------
+    `group_components_`: array of shape (n_features, 3 * n_components)
+        Leading left singular vectors of the concatenated subject PCAs.
+        Subjects are folded in one after the other, so that its size does
+        not depend on the number of subjects.
+
+    `group_singular_values_`: array of shape (3 * n_components, )
+        Corresponding singular values.
+
+    `n_subjects_`: int
+        Number of subjects in the group reduction.
+
+    `stability_`: array of shape (n_components, )
+        ICASSO stability index of each map, if n_init > 1: 1 for a map
+        found identically by every run, lower for less reproducible maps.
     """
 
     def __init__(self, n_components,
@@ -68,7 +388,7 @@ class CanICA(DecompositionModel, TransformerMixin):
                  kurtosis_thr=None,
                  maps_only=True,
                  random_state=None,
-                 n_jobs=1, verbose=0):
+                 n_jobs=1, verbose=0, n_init=1, dtype=np.float64):
         self.n_components = n_components
         self.memory = memory
         self.kurtosis_thr = kurtosis_thr
@@ -76,8 +396,18 @@ class CanICA(DecompositionModel, TransformerMixin):
         self.random_state = random_state
         self.n_jobs = n_jobs
         self.verbose = verbose
+        self.n_init = n_init
+        self.dtype = dtype
+
+    def _find_high_kurtosis(self, group_components, memory):
+        """ Run the ICA on an increasing number of group components until
+            enough maps have a high kurtosis.
 
-    def _find_high_kurtosis(self, pcas, memory):
+            group_components holds the leading left singular vectors of
+            the group, by decreasing singular value: the search slices
+            it, and each ICA is warm-started from the unmixing matrix of
+            the previous one.
+        """
         random_state = check_random_state(self.random_state)
 
         if not self.kurtosis_thr:
@@ -85,15 +415,16 @@ class CanICA(DecompositionModel, TransformerMixin):
         else:
             kurtosis_thr = self.kurtosis_thr
         n_components = self.n_components
+        w_init = None
 
-        while n_components < 3 * self.n_components:
-            group_maps = memory.cache(
-                randomized_svd)(pcas, n_components)[0]
-            group_maps = group_maps[:, :n_components]
-
-            ica_maps = memory.cache(fastica)(group_maps, whiten=False,
-                                             fun='cube',
-                                             random_state=random_state)[2]
+        # The group may have fewer components than the search needs
+        max_components = min(3 * self.n_components,
+                             group_components.shape[1] + 1)
+        while n_components < max_components:
+            group_maps = group_components[:, :n_components]
+            _, unmixing, ica_maps = memory.cache(fastica)(
+                group_maps, whiten=False, fun='cube', w_init=w_init,
+                random_state=random_state)
             ica_maps = ica_maps.T
             kurtosis = stats.kurtosis(ica_maps, axis=1)
             kurtosis_mask = kurtosis > kurtosis_thr
@@ -101,6 +432,9 @@ class CanICA(DecompositionModel, TransformerMixin):
                 order = np.argsort(kurtosis)[::-1]
                 ica_maps = ica_maps[order[:n_components]]
                 break
+            # The new component starts as the new group component
+            w_init = np.eye(n_components + 1)
+            w_init[:n_components, :n_components] = unmixing
             n_components += 1
 
             del group_maps
@@ -110,33 +444,109 @@ class CanICA(DecompositionModel, TransformerMixin):
         self.n_components_ = n_components
         return ica_maps
 
-    def fit(self, data, y=None):
-        if hasattr(data, 'copy'):
-            # It's an array
-            data = data.copy()
+    def _update_group_pca(self, data, memory):
+        """ Fold the PCA of each subject of data in the group reduction.
+        """
+        _update_group_pcas([self], data, memory, self.n_jobs, self.verbose)
+
+    def _stable_ica(self, group_components):
+        """ Run n_init FastICA in parallel on the group components, and keep
+            the most stable components.
+
+            If kurtosis_thr is set, the components whose kurtosis is above
+            the threshold are kept first.
+        """
+        # FastICA expects white data: with unit variance, rather than unit
+        # norm, components the restarts converge to the same sources
+        scale = np.sqrt(len(group_components))
+        group_maps = group_components * scale
+        random_state = check_random_state(self.random_state)
+        seeds = random_state.randint(np.iinfo(np.int32).max,
+                                     size=self.n_init)
+        temp_dir = None
+        if self.n_jobs != 1:
+            # The workers memory-map the group maps instead of receiving
+            # a copy
+            temp_dir = tempfile.mkdtemp(prefix='nisl_canica_')
+            group_maps = _dump_shared(group_maps,
+                                      os.path.join(temp_dir, 'maps.npy'))
+        try:
+            estimates = Parallel(n_jobs=self.n_jobs, verbose=self.verbose)(
+                delayed(_fastica_run)(group_maps, seed) for seed in seeds)
+        finally:
+            if temp_dir is not None:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+        n_clusters = estimates[0].shape[0]
+        maps, stability = _icasso(np.concatenate(estimates), n_clusters)
+        order = np.argsort(stability)[::-1]
+        if self.kurtosis_thr:
+            high = stats.kurtosis(maps[order], axis=1) > self.kurtosis_thr
+            order = np.concatenate((order[high], order[np.logical_not(high)]))
+        order = order[:self.n_components]
+        return maps[order] / scale, stability[order]
+
+    def _fit_maps(self, data, memory):
+        if self.n_init > 1 and not self.kurtosis_thr:
+            # Without a threshold, there is no search on the number of
+            # components
+            self.n_components_ = self.n_components
         else:
-            # Probably a list
-            data = copy.deepcopy(data)
+            ica_maps = self._find_high_kurtosis(self.group_components_,
+                                                memory)
+        if self.n_init > 1:
+            # The search only sets the number of group components
+            ica_maps, self.stability_ = self._stable_ica(
+                self.group_components_[:, :self.n_components_])
+        # sklearn's FastICA returns double precision sources
+        self.maps_ = ica_maps.astype(self.dtype)
+        if not self.maps_only:
+            # Relearn the time series
+            self.learn_from_maps(data)
+        return self
+
+    def fit(self, data, y=None):
+        """ Learn the maps from the data of a group of subjects.
 
+        Parameters
+        ----------
+        data: list of arrays of shape (n_samples, n_features)
+            The data of each subject. It is not modified, and may be
+            memory-mapped. If maps_only is True, it can be any iterable,
+            such as a generator loading the subjects one at a time.
+        """
         memory = self.memory
         if isinstance(memory, basestring):
             memory = Memory(cachedir=memory)
+        for name in ('group_components_', 'group_singular_values_',
+                     'n_subjects_'):
+            if hasattr(self, name):
+                delattr(self, name)
+        self._update_group_pca(data, memory)
+        return self._fit_maps(data, memory)
 
-        pcas = Parallel(n_jobs=self.n_jobs, verbose=self.verbose)(
-            delayed(_subject_pca)(subject_data,
-                                 n_components=self.n_components, mem=memory)
-            for subject_data in data)
-        pcas = np.concatenate(pcas, axis=1)
+    def partial_fit(self, data, y=None):
+        """ Add subjects to the group, and update the maps.
 
-        ica_maps = self._find_high_kurtosis(pcas, memory)
+        The group reduction of the subjects seen by previous calls to fit
+        or partial_fit is updated with the new subjects, that are the only
+        ones whose PCA is computed.
 
-        del pcas
-        self.maps_ = ica_maps
-        if not self.maps_only:
-            # Relearn the time series
-            self.learn_from_maps(data)
+        If maps_only is False, the time series, cov_ and residuals_ are
+        learned from the new subjects only: the maps change with each
+        call, and the data of the previous subjects is not kept to relearn
+        them. Call learn_from_maps with the data of all the subjects to
+        model the whole group.
 
-        return self
+        Parameters
+        ----------
+        data: list of arrays of shape (n_samples, n_features)
+            The data of each new subject.
+        """
+        memory = self.memory
+        if isinstance(memory, basestring):
+            memory = Memory(cachedir=memory)
+        self._update_group_pca(data, memory)
+        return self._fit_maps(data, memory)
 
     def transform(self, X, y=None):
         """Apply un-mixing matrix "W" to X to recover the sources
@@ -144,3 +554,177 @@ class CanICA(DecompositionModel, TransformerMixin):
             S = X * W.T
         """
         return np.dot(X, self.maps_.T)
+
+    def dual_regression(self, data, store=None):
+        """ Subject specific time courses and maps of the group maps.
+
+        The group maps are regressed on the data of each subject to get
+        its time courses, that are in turn regressed on the data to get
+        its maps. The Gram matrix of the group maps is factorized once for
+        all the subjects, that are processed in parallel on n_jobs CPUs.
+
+        Parameters
+        ----------
+        data: list of arrays of shape (n_samples, n_features)
+            The data of each subject. It is not modified, and can be any
+            iterable, such as a generator loading the subjects one at a
+            time, or a MaskedDataStore.
+
+        store: string, optional
+            If given, the results are saved, in the dtype of the maps, in
+            this directory, and returned as memory-mapped arrays: only
+            n_jobs subjects are held in memory at a time. The time courses
+            of all the subjects are stacked in timecourses.dat, and their
+            maps in maps.dat, as raw C-ordered arrays. offsets.npy gives
+            the first sample of the time courses of each subject, the
+            last entry being the total number of samples.
+
+        Returns
+        -------
+        timecourses: list of arrays of shape (n_samples, n_components)
+            The time courses of each subject.
+
+        subject_maps: list of arrays of shape (n_components, n_features)
+            The maps of each subject.
+        """
+        maps = self.maps_
+        maps_cholesky = _maps_cholesky(maps)
+        n_jobs = self.n_jobs
+        if n_jobs < 0:
+            n_jobs = cpu_count() + 1 + n_jobs
+        if store is not None:
+            if not os.path.exists(store):
+                os.makedirs(store)
+            for name in ('timecourses', 'maps'):
+                open(os.path.join(store, '%s.dat' % name), 'wb').close()
+        n_components, n_features = maps.shape
+        dtype = maps.dtype
+        offsets = [0]
+        temp_dir = None
+        if n_jobs != 1:
+            # The workers memory-map the maps instead of receiving a copy
+            # with each subject
+            temp_dir = tempfile.mkdtemp(prefix='nisl_canica_')
+            maps = _dump_shared(maps, os.path.join(temp_dir, 'maps.npy'))
+        timecourses = list()
+        subject_maps = list()
+        data = iter(data)
+        try:
+            while True:
+                chunk = list(itertools.islice(data, max(n_jobs, 1)))
+                if not chunk:
+                    break
+                start = len(offsets) - 1
+                for subject_data in chunk:
+                    offsets.append(offsets[-1] + len(subject_data))
+                if store is not None:
+                    # The workers write their results in place
+                    _grow_file(os.path.join(store, 'timecourses.dat'),
+                               offsets[-1] * n_components * dtype.itemsize)
+                    _grow_file(os.path.join(store, 'maps.dat'),
+                               (len(offsets) - 1) * n_components
+                               * n_features * dtype.itemsize)
+                results = Parallel(n_jobs=n_jobs, verbose=self.verbose)(
+                    delayed(_dual_regression)(maps, maps_cholesky,
+                                              subject_data, store,
+                                              start + index,
+                                              offsets[start + index])
+                    for index, subject_data in enumerate(chunk))
+                del chunk
+                if store is None:
+                    for result in results:
+                        timecourses.append(result[0])
+                        subject_maps.append(result[1])
+        finally:
+            if temp_dir is not None:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+        if store is not None:
+            offsets = np.array(offsets)
+            np.save(os.path.join(store, 'offsets.npy'), offsets)
+            n_subjects = len(offsets) - 1
+            # Empty files cannot be memory-mapped
+            stored = np.empty((0, n_components), dtype=dtype)
+            if offsets[-1]:
+                stored = _results_memmap(store, 'timecourses', dtype,
+                                         (offsets[-1], n_components),
+                                         mode='r')
+            timecourses = [stored[offsets[i]:offsets[i + 1]]
+                           for i in range(n_subjects)]
+            if n_subjects:
+                subject_maps = list(_results_memmap(
+                    store, 'maps', dtype,
+                    (n_subjects, n_components, n_features), mode='r'))
+        return timecourses, subject_maps
+
+
+def _fit_ica(estimator, memory):
+    """ Learn the maps of an estimator whose group reduction is computed.
+        The time series are not learned.
+    """
+    return estimator._fit_maps(None, memory)
+
+
+def select_n_components(estimator, train_data, test_data, n_components_list,
+                        n_jobs=1, verbose=0):
+    """ Fit CanICA for several numbers of components, and score each model
+        on held-out subjects.
+
+        The subject PCAs are computed once, with the largest number of
+        components, and sliced for the others. The ICA of the models is
+        then run in parallel, only the group components being sent to the
+        workers. The time series are learned, and the models scored, in
+        the calling process, one subject at a time.
+
+    Parameters
+    ----------
+    estimator: CanICA
+        The model to fit. Its n_components is set to each value of
+        n_components_list.
+
+    train_data: list of arrays of shape (n_samples, n_features)
+        The data of the subjects used to fit the models. It is read
+        several times, and can be a MaskedDataStore or a list of
+        memory-mapped arrays.
+
+    test_data: list of arrays of shape (n_samples, n_features)
+        The data of the held-out subjects used to score the models.
+
+    n_components_list: list of int
+        The numbers of components to try.
+
+    n_jobs: int, optional
+        The number of CPUs used to compute the subject PCAs and to run the
+        ICA of the models.
+
+    verbose: int, optional
+        The verbosity level.
+
+    Returns
+    -------
+    scores: array of shape (len(n_components_list), )
+        Log likelihood of test_data under each model.
+
+    best_estimator: CanICA
+        The fitted model with the highest score.
+    """
+    memory = estimator.memory
+    if isinstance(memory, basestring):
+        memory = Memory(cachedir=memory)
+    estimators = list()
+    for n_components in n_components_list:
+        # The parallelism is over the models
+        estimators.append(clone(estimator).set_params(
+            n_components=n_components, maps_only=True, n_jobs=1))
+    _update_group_pcas(estimators, train_data, memory, n_jobs=n_jobs,
+                       verbose=verbose)
+    estimators = Parallel(n_jobs=n_jobs, verbose=verbose)(
+        delayed(_fit_ica)(this_estimator, memory)
+        for this_estimator in estimators)
+    scores = list()
+    for this_estimator in estimators:
+        # The time series are needed to score the model
+        this_estimator.set_params(maps_only=False)
+        this_estimator.learn_from_maps(train_data)
+        scores.append(this_estimator.score(test_data))
+    scores = np.array(scores)
+    return scores, estimators[np.argmax(scores)]
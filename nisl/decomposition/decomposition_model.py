@@ -8,34 +8,105 @@ from sklearn.base import BaseEstimator
 from sklearn.utils.extmath import fast_logdet
 
 
+def _likelihood_statistics(series, maps, residues, center=False,
+                           block_size=500):
+    """ Sufficient statistics of series for log_likelihood.
+
+    Parameters
+    ----------
+    series: array of shape (n_samples, n_features)
+        The data, read in blocks of block_size samples.
+
+    maps: array of shape (n_features, n_maps)
+        The blocks of series are processed in the dtype of the maps. The
+        statistics are accumulated in double precision.
+
+    residues: array of shape (n_features, )
+
+    center: boolean, optional
+        If True, the mean of series is removed. series is not modified.
+
+    Returns
+    -------
+    n_samples: int
+
+    residues_fit: float
+        Sum of the squares of the series whitened by the residues.
+
+    projection_gram: array of shape (n_maps, n_maps)
+        Gram matrix of the projection of the series, whitened twice, on
+        the maps.
+    """
+    n_samples = series.shape[0]
+    dtype = maps.dtype
+    mean = 0
+    if center:
+        mean = series.mean(axis=0, dtype=np.float64).astype(dtype)
+    white_maps = (maps / residues[:, np.newaxis] ** 2).astype(dtype)
+    residues = residues.astype(dtype)
+    residues_fit = 0
+    projection_gram = np.zeros((maps.shape[1], maps.shape[1]))
+    for start in range(0, n_samples, block_size):
+        block = np.asarray(series[start:start + block_size],
+                           dtype=dtype) - mean
+        projection = np.dot(block, white_maps)
+        projection_gram += np.dot(projection.T, projection)
+        block /= residues
+        residues_fit += np.sum(block ** 2, dtype=np.float64)
+    return n_samples, residues_fit, projection_gram
+
+
+def _cholesky_logdet(cholesky):
+    """ Log-determinant of a matrix from its Cholesky factor. Only the
+        diagonal of the factor is used.
+    """
+    return 2 * np.sum(np.log(np.diag(cholesky)))
+
+
+def _log_likelihood(n_samples, residues_fit, projection_gram, cov, maps,
+                    residues):
+    """ Log likelihood from the statistics of _likelihood_statistics.
+    """
+    # This makes heavy use of the matrix inversion lemma
+    try:
+        cov_cholesky = linalg.cho_factor(cov)
+        n_maps = len(cov)
+        prec_maps = linalg.cho_solve(cov_cholesky, np.eye(n_maps))
+        white_maps = maps / residues[:, np.newaxis]
+        maps_gram = np.dot(white_maps.T, white_maps)
+        del white_maps
+        prec_maps += maps_gram
+        residues_fit -= np.trace(linalg.cho_solve(
+            linalg.cho_factor(prec_maps), projection_gram))
+        prec_maps += maps_gram
+        det = _cholesky_logdet(linalg.cho_factor(prec_maps)[0])
+        cov_det = _cholesky_logdet(cov_cholesky[0])
+    except linalg.LinAlgError:
+        return -np.inf
+    return (-residues_fit / n_samples - cov_det
+            - det - 2 * np.sum(np.log(residues)))
+
+
 def log_likelihood(test_series, cov, maps, residues):
     """ Return the log likelihood of test_series under the model
         described by cov, maps, and residues.
+
+        test_series is an array of shape (n_samples, n_features), or a list
+        of such arrays that are considered concatenated. It is processed
+        in blocks of samples, and not modified.
     """
-    # try:
-    # This makes heavy use of the matrix inversion lemma
-    #test_series = np.concatenate(test_series, axis=0)
-    n_samples = test_series.shape[0]
-    white_test_series = test_series / residues
-    residues_fit = np.sum(white_test_series ** 2)
-    white_test_series /= residues
-    white_projection = np.dot(white_test_series, maps)
-    del white_test_series
-    prec_maps = linalg.inv(cov)
-    prec_maps += np.dot(maps.T / residues ** 2, maps)
-    residues_fit -= np.trace(
-        np.dot(np.dot(white_projection.T, white_projection),
-               linalg.inv(prec_maps)))
-    del white_projection
-    white_maps = maps / residues[:, np.newaxis]
-    prec_maps += np.dot(white_maps.T, white_maps)
-    del white_maps
-    det = fast_logdet(prec_maps)
-    del prec_maps
-    return (-residues_fit / n_samples - fast_logdet(cov)
-            - det - 2 * np.sum(np.log(residues)))
-    #except linalg.LinAlgError:
-    #    return -np.inf
+    if hasattr(test_series, 'shape') and len(test_series.shape) == 2:
+        test_series = [test_series]
+    n_samples = 0
+    residues_fit = 0
+    projection_gram = 0
+    for series in test_series:
+        stats = _likelihood_statistics(series, maps, residues)
+        n_samples += stats[0]
+        residues_fit += stats[1]
+        projection_gram = projection_gram + stats[2]
+    return _log_likelihood(n_samples, residues_fit, projection_gram, cov,
+                           maps, residues)
 
 
 def log_likelihood_full(test_series, full_cov):
@@ -49,38 +120,95 @@ def log_likelihood_full(test_series, full_cov):
                         test_series.T))
 
 
-def learn_time_series(maps, subject_data):
+def _maps_cholesky(maps):
+    """ Cholesky factorization of the Gram matrix of the maps, with a very
+        small regularisation to control its conditioning. It is computed in
+        double precision whatever the dtype of the maps.
+    """
+    maps_cov = np.asarray(np.dot(maps, maps.T), dtype=np.float64)
+    n_maps = len(maps_cov)
+    maps_cov.flat[::n_maps + 1] += .01 * np.trace(maps_cov) / n_maps
+    return linalg.cho_factor(maps_cov, overwrite_a=True)
+
+
+def learn_time_series(maps, subject_data, maps_cholesky=None):
     # For this, we do a ridge regression with a very small
     # regularisation, corresponds to a least square with control on
     # the conditioning
-    maps_cov = np.dot(maps, maps.T)
-    n_maps = len(maps_cov)
-    maps_cov.flat[::n_maps + 1] += .01 * np.trace(maps_cov) / n_maps
-    u = linalg.solve(maps_cov, np.dot(maps, subject_data.T),
-                     sym_pos=True, overwrite_a=True, overwrite_b=True)
-    residuals = np.dot(u.T, maps)
+    if maps_cholesky is None:
+        maps_cholesky = _maps_cholesky(maps)
+    u = linalg.cho_solve(maps_cholesky, np.dot(maps, subject_data.T),
+                         overwrite_b=True)
+    # The residuals are computed in the dtype of the maps, and averaged in
+    # double precision
+    residuals = np.dot(np.asarray(u.T, dtype=maps.dtype), maps)
     residuals -= subject_data
     residuals **= 2
-    residuals = np.mean(residuals, axis=0)
+    residuals = np.mean(residuals, axis=0, dtype=np.float64)
     return u, residuals
 
 
+def _learn_time_series_residual(maps, subject_data, maps_cov,
+                                maps_cholesky):
+    """ Time series of the maps in subject_data, and the sum of the squared
+        residuals of the fit.
+
+        maps_cov is the Gram matrix of the maps, and maps_cholesky the
+        factorization returned by _maps_cholesky. The residuals are
+        computed from the Gram matrices, without forming the
+        (n_samples, n_features) residual matrix, and accumulated in double
+        precision.
+    """
+    projection = np.dot(maps, subject_data.T)
+    u = linalg.cho_solve(maps_cholesky, projection)
+    residual = (np.sum(u * np.dot(maps_cov, u))
+                - 2 * np.sum(u * projection)
+                + np.einsum('ij,ij->', subject_data, subject_data,
+                            dtype=np.float))
+    return u, max(residual, 0)
+
+
 ###############################################################################
 # Base model
 class DecompositionModel(BaseEstimator):
+    """ Model of the data as maps, their time series and a residual.
+
+    Parameters
+    ----------
+    dtype: numpy dtype, optional
+        Floating point type of the maps. The data is projected on the maps
+        in this dtype, and the statistics of the projection are accumulated
+        in double precision.
+    """
+
+    def __init__(self, dtype=np.float64):
+        self.dtype = dtype
 
     def score(self, test_series):
+        """ Log likelihood of test data under the model.
+
+        Parameters
+        ----------
+        test_series: array of shape (n_samples, n_features), or list of
+            such arrays, one per subject
+            The mean of each subject is removed before scoring. The data is
+            accumulated subject by subject, in blocks, and is not modified.
+        """
         # XXX: might need to relearn maps
-        if len(test_series[0].shape) == 2:
-            for series in test_series:
-                series -= series.mean(axis=0)
-            # n_subjects = len(test_series)
-            n_samples, n_voxels = test_series[0].shape
-            test_series = np.concatenate(test_series, axis=0)
-        else:
-            test_series -= test_series.mean(axis=0)
-        return log_likelihood(test_series, self.cov_, self.maps_.T,
-                              self.residuals_)
+        if len(test_series[0].shape) != 2:
+            test_series = [test_series]
+        maps = self.maps_.T
+        n_samples = 0
+        residues_fit = 0
+        projection_gram = 0
+        for series in test_series:
+            stats = _likelihood_statistics(series, maps, self.residuals_,
+                                           center=True)
+            n_samples += stats[0]
+            residues_fit += stats[1]
+            projection_gram = projection_gram + stats[2]
+        return _log_likelihood(n_samples, residues_fit, projection_gram,
+                               self.cov_, maps, self.residuals_)
 
     def get_full_cov(self):
         """ Return the full covariance for a model described by cov, maps and
@@ -96,35 +224,34 @@ class DecompositionModel(BaseEstimator):
         """ Learn time-series and covariance from the maps.
         """
         # Remove any map with only zero values:
-        self.maps_ = self.maps_[self.maps_.ptp(axis=1) != 0]
+        self.maps_ = self.maps_[self.maps_.ptp(axis=1) != 0].astype(
+            self.dtype)
         if not len(self.maps_):
             # All maps are zero
             self.cov_ = np.array([[]], dtype=np.float)
             return
         # Flip sign to always have positive features
-        for map in self.maps_:
-            mask = map > 0
-            if map[mask].sum() > - map[np.logical_not(mask)].sum():
-                map *= -1
-
-        # Relearn U, V to have the right scaling on U
-        residuals = None
-        #residuals = 0
+        positive = np.maximum(self.maps_, 0).sum(axis=1)
+        negative = np.maximum(-self.maps_, 0).sum(axis=1)
+        self.maps_[positive > negative] *= -1
+
+        # Relearn U, V to have the right scaling on U. The Gram matrix of
+        # the maps is factorized once for all the subjects.
+        maps_cov = np.asarray(np.dot(self.maps_, self.maps_.T),
+                              dtype=np.float64)
+        maps_cholesky = _maps_cholesky(self.maps_)
+        residuals = 0
+        n_values = 0
         U = list()
         for d in data:
-            u, this_residuals = self.learn_time_series(d)
+            u, this_residuals = _learn_time_series_residual(
+                self.maps_, d, maps_cov, maps_cholesky)
             U.append(u)
-            #this_residuals = np.sqrt(np.mean(this_residuals))
-            #residuals += this_residuals
-            if residuals is None:
-                residuals = this_residuals
-            else:
-                residuals += this_residuals
-        residuals /= len(data)
-        #self.residuals_ = np.atleast_1d(residuals)
-        self.residuals_ = residuals  # = np.sqrt(residuals)
-        self.residuals_.fill(np.sqrt(self.residuals_.mean()))
-        del this_residuals, u, d
+            residuals += this_residuals / d.size
+            n_values += 1
+        # The residuals are the same for all features
+        self.residuals_ = np.empty(self.maps_.shape[1])
+        self.residuals_.fill(np.sqrt(residuals / n_values))
         U = np.concatenate(U, axis=1)
         n_samples = U.shape[1]
         S = np.sqrt((U ** 2).sum(axis=1) / n_samples)
@@ -1,7 +1,18 @@
 """Test CanICA"""
+import os
+import shutil
+import tempfile
+
 import numpy as np
-from numpy.testing import assert_array_equal
-from nisl.decomposition import CanICA
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+from nose.tools import assert_raises
+from scipy import linalg, stats
+
+from sklearn.externals.joblib import Memory
+
+from nisl.decomposition import CanICA, select_n_components
+from nisl.decomposition.canica import _icasso, _subject_pca, _truncated_pca
+from nisl.decomposition.decomposition_model import DecompositionModel
 
 
 def test_canica_square_img():
@@ -52,5 +63,205 @@ def test_canica_square_img():
         else:
             assert False, "Non matching component"
 
+
+def test_truncated_pca():
+    # The truncated PCA spans the leading singular subspace
+    rng = np.random.RandomState(0)
+    for shape in [(40, 100), (100, 30)]:
+        data = rng.normal(size=shape)
+        data[:, :5] *= 10
+        components = _truncated_pca(data, 5)
+        assert_array_equal(components.shape, (shape[1], 5))
+        assert_array_almost_equal(np.dot(components.T, components),
+                                  np.eye(5))
+        U = linalg.svd(data.T, full_matrices=False)[0][:, :5]
+        assert_array_almost_equal(np.dot(components, components.T),
+                                  np.dot(U, U.T))
+
+
+def test_subject_pca():
+    # The blockwise standardization does not modify the data, and gives
+    # the components of the standardized data
+    rng = np.random.RandomState(0)
+    for shape in [(40, 100), (100, 30)]:
+        data = rng.normal(size=shape) * 3 + 2
+        data[:, 3] = 1
+        data.flags.writeable = False
+        components = _subject_pca(data, 5, Memory(cachedir=None),
+                                  block_size=7)
+        standardized = data - data.mean(axis=0)
+        std = standardized.std(axis=0)
+        std[std == 0] = 1
+        standardized /= std
+        expected = _truncated_pca(standardized, 5)
+        assert_array_almost_equal(np.dot(components, components.T),
+                                  np.dot(expected, expected.T))
+
+
+def test_incremental_group_pca():
+    # Subjects folded in one at a time, or added by partial_fit, give the
+    # same group reduction as the SVD of the concatenated subject PCAs
+    rng = np.random.RandomState(0)
+    data = [rng.normal(size=(20, 50)) for _ in range(3)]
+    pcas = np.hstack([_subject_pca(d, 2, Memory(cachedir=None))
+                      for d in data])
+    U, s, _ = linalg.svd(pcas, full_matrices=False)
+    canica = CanICA(n_components=2, random_state=0)
+    canica.fit(data)
+    assert_array_almost_equal(canica.group_singular_values_, s)
+    components = canica.group_components_
+    assert_array_almost_equal(np.dot(components, components.T),
+                              np.dot(U, U.T))
+    canica = CanICA(n_components=2, random_state=0)
+    canica.fit(data[:1])
+    canica.partial_fit(iter(data[1:]))
+    assert_array_equal(canica.n_subjects_, 3)
+    assert_array_almost_equal(canica.group_singular_values_, s)
+    # The time series are learned from the new subjects only
+    canica = CanICA(n_components=2, random_state=0, maps_only=False)
+    canica.fit(data[:1])
+    canica.partial_fit(data[1:])
+    model = DecompositionModel()
+    model.maps_ = CanICA(n_components=2, random_state=0).fit(data).maps_
+    model.learn_from_maps(data[1:])
+    assert_array_almost_equal(canica.cov_, model.cov_)
+    assert_array_almost_equal(canica.residuals_, model.residuals_)
+
+
+def test_kurtosis_search():
+    # The search slices the group components and warm-starts each ICA,
+    # until it runs out of candidate numbers of components
+    rng = np.random.RandomState(0)
+    data = [rng.normal(size=(20, 200)) for _ in range(3)]
+    canica = CanICA(n_components=3, kurtosis_thr=1000., random_state=0)
+    assert_raises(ValueError, canica.fit, data)
+    canica = CanICA(n_components=3, kurtosis_thr=-1000., random_state=0)
+    canica.fit(data)
+    assert_array_equal(canica.maps_.shape, (3, 200))
+
+
+def test_icasso():
+    # Components found by every run, up to order and sign, are stable
+    rng = np.random.RandomState(0)
+    sources = rng.laplace(size=(3, 500))
+    estimates = []
+    for run in range(4):
+        signs = rng.permutation([-1, 1, 1])[:, np.newaxis]
+        estimates.append(signs * sources[rng.permutation(3)]
+                         + .01 * rng.normal(size=(3, 500)))
+    maps, stability = _icasso(np.concatenate(estimates), 3)
+    assert_array_equal(maps.shape, (3, 500))
+    assert np.all(stability > .9)
+    correlation = np.abs(np.corrcoef(np.vstack((maps, sources)))[:3, 3:])
+    assert_array_almost_equal(np.sort(correlation.max(axis=1)), 1, 3)
+    # A component found by a single run is the least stable
+    noise = rng.normal(size=(1, 500))
+    maps, stability = _icasso(np.concatenate(estimates + [noise]), 4)
+    noise_cluster = np.argmax(np.abs(np.corrcoef(maps, noise)[-1, :4]))
+    assert_array_equal(np.argmin(stability), noise_cluster)
+
+    data = [rng.normal(size=(20, 200)) for _ in range(3)]
+    canica = CanICA(n_components=3, n_init=3, random_state=0)
+    canica.fit(data)
+    assert_array_equal(canica.maps_.shape, (3, 200))
+    assert_array_equal(canica.stability_.shape, (3, ))
+    # The kurtosis threshold applies to the stable maps
+    canica = CanICA(n_components=3, n_init=3, kurtosis_thr=-1000.,
+                    random_state=0)
+    canica.fit(data)
+    assert_array_equal(canica.maps_.shape, (3, 200))
+    group_components = canica.group_components_[:, :3]
+    maps, _ = canica._stable_ica(group_components)
+    canica.kurtosis_thr = np.median(stats.kurtosis(maps, axis=1))
+    maps, _ = canica._stable_ica(group_components)
+    assert_array_equal(stats.kurtosis(maps, axis=1) > canica.kurtosis_thr,
+                       [True, False, False])
+
+
+def test_select_n_components():
+    # The sweep shares the subject PCAs between the models, and gives the
+    # same models as separate fits
+    rng = np.random.RandomState(0)
+    maps = rng.laplace(size=(3, 200))
+    data = [np.dot(rng.normal(size=(30, 3)), maps)
+            + .5 * rng.normal(size=(30, 200)) for _ in range(5)]
+    canica = CanICA(n_components=2, random_state=0)
+    scores, best = select_n_components(canica, data[:3], data[3:], [2, 3, 4])
+    assert_array_equal(scores.shape, (3, ))
+    assert best.n_components in [2, 3, 4]
+    assert_array_almost_equal(best.score(data[3:]), scores.max())
+    for n_components in [2, 4]:
+        canica = CanICA(n_components=n_components, random_state=0,
+                        maps_only=False)
+        canica.fit(data[:3])
+        assert_array_almost_equal(
+            canica.score(data[3:]),
+            scores[[2, 3, 4].index(n_components)])
+
+
+def test_float32():
+    # In single precision, the subject PCAs, the group reduction and the
+    # maps stay in float32, and match the double precision ones
+    rng = np.random.RandomState(0)
+    data = [rng.normal(size=(20, 50)).astype(np.float32) for _ in range(3)]
+    for shape in [(20, 50), (50, 20)]:
+        components = _subject_pca(data[0].reshape(shape), 5,
+                                  Memory(cachedir=None), block_size=7,
+                                  dtype=np.float32)
+        assert components.dtype == np.float32
+        expected = _subject_pca(data[0].reshape(shape), 5,
+                                Memory(cachedir=None))
+        assert_array_almost_equal(np.dot(components, components.T),
+                                  np.dot(expected, expected.T), 4)
+    canica = CanICA(n_components=2, random_state=0, dtype=np.float32,
+                    maps_only=False)
+    canica.fit(data)
+    canica64 = CanICA(n_components=2, random_state=0).fit(data)
+    assert canica.group_components_.dtype == np.float32
+    assert canica.maps_.dtype == np.float32
+    assert_array_almost_equal(canica.group_singular_values_ /
+                              canica64.group_singular_values_, 1, 4)
+    assert canica.transform(data[0]).dtype == np.float32
+
+
+def test_dual_regression():
+    # Dual regression recovers the time courses and the maps of each
+    # subject, and streams them to a store
+    rng = np.random.RandomState(0)
+    maps = rng.laplace(size=(3, 200))
+    timecourses = [rng.normal(size=(30, 3)) for _ in range(4)]
+    subject_maps = [maps + .1 * rng.normal(size=maps.shape)
+                    for _ in range(4)]
+    data = [np.dot(t, m) for t, m in zip(timecourses, subject_maps)]
+    canica = CanICA(n_components=3, random_state=0)
+    canica.maps_ = maps
+    estimated = canica.dual_regression(data)
+    for t, m, t_est, m_est in zip(timecourses, subject_maps, *estimated):
+        assert_array_equal(t_est.shape, (30, 3))
+        assert_array_equal(m_est.shape, (3, 200))
+        # The regressions are slightly regularized
+        assert np.all(np.diag(np.corrcoef(t.T, t_est.T)[:3, 3:]) > .99)
+        assert np.all(np.diag(np.corrcoef(m, m_est)[:3, 3:]) > .99)
+    temp_dir = tempfile.mkdtemp()
+    try:
+        store = os.path.join(temp_dir, 'dual_regression')
+        stored = canica.dual_regression(iter(data), store=store)
+        assert isinstance(stored[1][0], np.memmap)
+        for results, stored_results in zip(estimated, stored):
+            for result, stored_result in zip(results, stored_results):
+                assert_array_almost_equal(result, stored_result)
+        # The results of all the subjects are stored contiguously
+        assert_array_equal(sorted(os.listdir(store)),
+                           ['maps.dat', 'offsets.npy', 'timecourses.dat'])
+        assert_array_equal(np.load(os.path.join(store, 'offsets.npy')),
+                           [0, 30, 60, 90, 120])
+        stored_timecourses = np.fromfile(
+            os.path.join(store, 'timecourses.dat')).reshape((120, 3))
+        assert_array_almost_equal(stored_timecourses,
+                                  np.concatenate(estimated[0]))
+    finally:
+        shutil.rmtree(temp_dir)
+
+
 if __name__ == "__main__":
     test_canica_square_img()
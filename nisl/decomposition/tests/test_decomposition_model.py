@@ -0,0 +1,85 @@
+"""Test the DecompositionModel"""
+import numpy as np
+from numpy.testing import assert_array_almost_equal
+
+from nisl.decomposition.decomposition_model import DecompositionModel, \
+    learn_time_series, log_likelihood, _likelihood_statistics
+
+
+def _make_data(rng, n_subjects=3, n_maps=5, n_samples=40, n_features=300):
+    maps = rng.normal(size=(n_maps, n_features))
+    data = [np.dot(rng.normal(size=(n_samples, n_maps)), maps)
+            + rng.normal(size=(n_samples, n_features))
+            for _ in range(n_subjects)]
+    return maps, data
+
+
+def test_learn_from_maps():
+    # Factorizing the maps once gives the same model as fitting each
+    # subject with learn_time_series
+    rng = np.random.RandomState(0)
+    maps, data = _make_data(rng)
+    model = DecompositionModel()
+    model.maps_ = maps.copy()
+    model.learn_from_maps(data)
+
+    positive = np.maximum(maps, 0).sum(axis=1)
+    negative = np.maximum(-maps, 0).sum(axis=1)
+    maps[positive > negative] *= -1
+    U, residuals = zip(*[learn_time_series(maps, d) for d in data])
+    residuals = np.sqrt(np.mean(residuals))
+    assert_array_almost_equal(model.residuals_,
+                              residuals * np.ones(maps.shape[1]))
+    U = np.concatenate(U, axis=1)
+    S = np.sqrt((U ** 2).sum(axis=1) / U.shape[1])
+    assert_array_almost_equal(model.maps_, maps * S[:, np.newaxis])
+    U /= S[:, np.newaxis]
+    assert_array_almost_equal(model.cov_, np.dot(U, U.T) / U.shape[1])
+
+
+def test_score():
+    # Scoring subject by subject, in blocks, does not modify the data and
+    # gives the log likelihood of the concatenated centered data
+    rng = np.random.RandomState(0)
+    maps, data = _make_data(rng)
+    model = DecompositionModel()
+    model.maps_ = maps
+    model.learn_from_maps(data)
+    _, test_series = _make_data(rng, n_samples=700)
+    test_series = [series + 1 for series in test_series]
+    test_copy = [series.copy() for series in test_series]
+    score = model.score(test_series)
+    for series, series_copy in zip(test_series, test_copy):
+        assert_array_almost_equal(series, series_copy)
+    centered = np.concatenate([series - series.mean(axis=0)
+                               for series in test_series])
+    assert_array_almost_equal(
+        score, log_likelihood(centered, model.cov_, model.maps_.T,
+                              model.residuals_))
+    stats = _likelihood_statistics(centered, model.maps_.T,
+                                   model.residuals_, block_size=10000)
+    stats_blocks = _likelihood_statistics(centered, model.maps_.T,
+                                          model.residuals_, block_size=33)
+    for stat, stat_blocks in zip(stats, stats_blocks):
+        assert_array_almost_equal(stat, stat_blocks)
+
+
+def test_float32():
+    # A single precision model matches the double precision one
+    rng = np.random.RandomState(0)
+    maps, data = _make_data(rng)
+    model = DecompositionModel()
+    model.maps_ = maps
+    model.learn_from_maps(data)
+    data32 = [d.astype(np.float32) for d in data]
+    model32 = DecompositionModel(dtype=np.float32)
+    model32.maps_ = maps
+    model32.learn_from_maps(data32)
+    assert model32.maps_.dtype == np.float32
+    assert_array_almost_equal(model32.maps_ / model.maps_, 1, 4)
+    assert_array_almost_equal(model32.cov_, model.cov_, 4)
+    assert_array_almost_equal(model32.residuals_ / model.residuals_, 1, 4)
+    assert_array_almost_equal(model32.score(data32) / model.score(data), 1,
+                              4)
+    u, residuals = learn_time_series(model32.maps_, data32[0])
+    assert residuals.dtype == np.float64
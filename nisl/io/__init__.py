@@ -4,3 +4,4 @@ tools to preprocess neuro-imaging data.
 """
 from .nifti_masker import NiftiMasker
 from .nifti_multi_masker import NiftiMultiMasker
+from .masked_data_store import MaskedDataStore
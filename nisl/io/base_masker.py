@@ -23,6 +23,63 @@ def _to_nifti(X, affine):
     return X
 
 
+def _filter_and_mask(niimgs, mask_img, parameters, sessions=None,
+                     confounds=None, copy=True, verbose=0, class_name=''):
+    """ Resample, mask and clean the signals of niimgs
+
+    Returns the preprocessed data and the affine of the resampled images.
+    parameters holds the target_affine, target_shape, smooth, low_pass,
+    high_pass, t_r, detrend and standardize parameters of the masker.
+    """
+    niimgs = utils.check_niimgs(niimgs)
+
+    # Resampling: allows the user to change the affine, the shape or both
+    if verbose > 1:
+        print "[%s.transform] Resampling" % class_name
+    niimgs = resampling.resample_img(
+        niimgs,
+        target_affine=parameters['target_affine'],
+        target_shape=parameters['target_shape'],
+        copy=copy)
+
+    # Get series from data with optional smoothing
+    if verbose > 1:
+        print "[%s.transform] Masking and smoothing" % class_name
+    data = masking.apply_mask(niimgs, mask_img, smooth=parameters['smooth'])
+
+    # Temporal
+    # ========
+    # Detrending (optional)
+    # Filtering (grab TR from header)
+    # Confounds (from csv file or numpy array)
+    # Normalizing
+
+    if verbose > 1:
+        print "[%s.transform] Cleaning signal" % class_name
+    clean_parameters = dict(low_pass=parameters['low_pass'],
+                            high_pass=parameters['high_pass'],
+                            t_r=parameters['t_r'],
+                            detrend=parameters['detrend'],
+                            standardize=parameters['standardize'])
+    if sessions is None:
+        data = signals.clean(data, confounds=confounds, **clean_parameters)
+    else:
+        for s in np.unique(sessions):
+            if confounds is not None:
+                confounds = confounds[sessions == s]
+            data[:, sessions == s] = signals.clean(
+                data[:, sessions == s], confounds=confounds,
+                **clean_parameters)
+
+    # For _later_: missing value removal or imputing of missing data
+    # (i.e. we want to get rid of NaNs, if smoothing must be done
+    # earlier)
+    # Optionally: 'doctor_nan', remove voxels with NaNs, other option
+    # for later: some form of imputation
+
+    return data, niimgs.get_affine()
+
+
 class BaseMasker(BaseEstimator, TransformerMixin, CacheMixin):
     """Base class for NiftiMaskers
     """
@@ -45,59 +102,20 @@ class BaseMasker(BaseEstimator, TransformerMixin, CacheMixin):
         if isinstance(niimgs, basestring):
             copy = False
 
-        niimgs = utils.check_niimgs(niimgs)
-
-        # Resampling: allows the user to change the affine, the shape or both
-        if self.verbose > 1:
-            print "[%s.transform] Resampling" % self.__class__.__name__
-        niimgs = self._cache(resampling.resample_img, memory_level=2)(
-            niimgs,
-            target_affine=self.target_affine,
-            target_shape=self.target_shape,
-            copy=copy)
-
-        # Get series from data with optional smoothing
-        if self.verbose > 1:
-            print "[%s.transform] Masking and smoothing" \
-                % self.__class__.__name__
-        data = masking.apply_mask(niimgs, self.mask_img_, smooth=self.smooth)
-
-        # Temporal
-        # ========
-        # Detrending (optional)
-        # Filtering (grab TR from header)
-        # Confounds (from csv file or numpy array)
-        # Normalizing
-
-        if self.verbose > 1:
-            print "[%s.transform] Cleaning signal" % self.__class__.__name__
-        if sessions is None:
-            data = self._cache(signals.clean, memory_level=2)(
-                data,
-                confounds=confounds, low_pass=self.low_pass,
-                high_pass=self.high_pass, t_r=self.t_r,
-                detrend=self.detrend,
-                standardize=self.standardize)
-        else:
-            for s in np.unique(sessions):
-                if confounds is not None:
-                    confounds = confounds[sessions == s]
-                data[:, sessions == s] = self._cache(signals.clean,
-                                                    memory_level=2)(
-                    data[:, sessions == s],
-                    confounds=confounds,
-                    low_pass=self.low_pass,
-                    high_pass=self.high_pass, t_r=self.t_r,
-                    detrend=self.detrend,
-                    standardize=self.standardize)
-
-        # For _later_: missing value removal or imputing of missing data
-        # (i.e. we want to get rid of NaNs, if smoothing must be done
-        # earlier)
-        # Optionally: 'doctor_nan', remove voxels with NaNs, other option
-        # for later: some form of imputation
-
-        self.affine_ = niimgs.get_affine()
+        # The whole preprocessing is cached, so that a cached result does
+        # not require to load, resample and mask the images again
+        parameters = dict(target_affine=self.target_affine,
+                          target_shape=self.target_shape,
+                          smooth=self.smooth, low_pass=self.low_pass,
+                          high_pass=self.high_pass, t_r=self.t_r,
+                          detrend=self.detrend,
+                          standardize=self.standardize)
+        data, self.affine_ = self._cache(_filter_and_mask, memory_level=2,
+                                         ignore=['copy', 'verbose',
+                                                 'class_name'])(
+            niimgs, self.mask_img_, parameters, sessions=sessions,
+            confounds=confounds, copy=copy,
+            verbose=self.verbose, class_name=self.__class__.__name__)
         return data
 
     def fit_transform(self, X, y=None, confounds=None, **fit_params):
@@ -0,0 +1,149 @@
+"""
+On-disk store for the masked data of several subjects.
+"""
+# License: simplified BSD
+
+import os
+
+import numpy as np
+from nibabel import Nifti1Image
+
+
+class MaskedDataStore(object):
+    """Masked data of several subjects stored in a single memory-mapped file
+
+    The (time, voxel) matrices of all the subjects are stacked along time
+    in one contiguous .npy file. The offset of each subject, optional
+    session labels and the mask used to extract the data are stored
+    alongside, so that the store can be reopened without any reference to
+    the original images. Stores are created with MaskedDataStore.create or
+    by NiftiMultiMasker.transform.
+
+    Parameters
+    ----------
+    path: string
+        Directory of an existing store.
+
+    mmap_mode: {'r', 'r+', 'c'}, optional
+        Memmapping mode used to open the data.
+
+    Attributes
+    ----------
+    `data`: numpy memmap of shape (n_samples, n_voxels)
+        Masked data of all the subjects, stacked along time.
+
+    `offsets`: numpy array of shape (n_subjects + 1, )
+        The data of subject i spans rows offsets[i] to offsets[i + 1].
+
+    `sessions`: numpy array of shape (n_samples, ) or None
+        Session label of each sample, if provided at creation.
+
+    `mask_img_`: Nifti1Image
+        The mask used to extract the data.
+
+    Notes
+    -----
+    Indexing the store returns views on the memory-mapped file: no data is
+    copied nor read from the disk until it is accessed.
+    """
+
+    data_file = 'data.npy'
+    metadata_file = 'metadata.npz'
+
+    def __init__(self, path, mmap_mode='r'):
+        self.path = path
+        metadata = np.load(os.path.join(path, self.metadata_file))
+        self.offsets = metadata['offsets']
+        self.sessions = None
+        if 'sessions' in metadata.files:
+            self.sessions = metadata['sessions']
+        self.mask_img_ = Nifti1Image(metadata['mask'].astype(np.int),
+                                     metadata['affine'])
+        self.data = np.load(os.path.join(path, self.data_file),
+                            mmap_mode=mmap_mode)
+
+    @classmethod
+    def create(cls, path, n_samples, mask_img, sessions=None,
+               dtype=np.float32):
+        """ Allocate a new store on disk and open it for writing
+
+        Parameters
+        ----------
+        path: string
+            Directory in which the store is created.
+
+        n_samples: list of integers
+            Number of samples (scans) of each subject.
+
+        mask_img: Nifti1Image
+            Mask used to extract the data.
+
+        sessions: array-like of shape (sum(n_samples), ), optional
+            Session label of each sample.
+
+        dtype: numpy dtype, optional
+            Data type of the stored data.
+
+        Returns
+        -------
+        store: MaskedDataStore
+            The new store, opened in 'r+' mode. Its content is undefined
+            until it has been written.
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        offsets = np.concatenate(([0], np.cumsum(n_samples))).astype(np.int)
+        mask = mask_img.get_data().astype(np.bool)
+        metadata = dict(offsets=offsets, mask=mask,
+                        affine=mask_img.get_affine())
+        if sessions is not None:
+            sessions = np.asarray(sessions)
+            if sessions.shape != (offsets[-1], ):
+                raise ValueError('sessions must have one label per sample '
+                                 '(%d), %s given'
+                                 % (offsets[-1], repr(sessions.shape)))
+            metadata['sessions'] = sessions
+        np.savez(os.path.join(path, cls.metadata_file), **metadata)
+        data = np.lib.format.open_memmap(
+            os.path.join(path, cls.data_file), mode='w+', dtype=dtype,
+            shape=(offsets[-1], mask.sum()))
+        del data
+        return cls(path, mmap_mode='r+')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        """ Return the data of the given subject, as a view on the file.
+        """
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Subject index %d out of range' % index)
+        return self.data[self.offsets[index]:self.offsets[index + 1]]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def get_voxels(self, start, stop, subject=None):
+        """ Return the data of a range of voxels, as a view on the file.
+
+        Parameters
+        ----------
+        start, stop: integers
+            Range of voxels (columns of the masked data).
+
+        subject: integer, optional
+            If given, only the data of this subject is returned, otherwise
+            the data of all subjects, stacked along time.
+        """
+        if subject is None:
+            return self.data[:, start:stop]
+        return self[subject][:, start:stop]
+
+    def flush(self):
+        """ Write any change of the data to the disk.
+        """
+        if hasattr(self.data, 'flush'):
+            self.data.flush()
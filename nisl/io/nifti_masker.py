@@ -88,6 +88,26 @@ class NiftiMasker(BaseMasker, CacheMixin):
         Rough estimator of the amount of memory used by caching. Higher value
         means more memory for caching.
 
+    memory_mmap_mode: {None, 'r+', 'r', 'w+', 'c'}, optional
+        Memmapping mode used to load arrays from the cache, e.g. 'r' to
+        memory-map them instead of reading them in full. If None, cached
+        results are entirely loaded in memory.
+
+    memory_max_bytes: integer, optional
+        Maximum size of the cache directory, in bytes. When it is exceeded,
+        least recently used results are evicted. By default, the cache
+        grows without bound.
+
+    memory_ram_max_bytes: integer, optional
+        If given, the most recently used cached results are additionally
+        kept in memory, up to this number of bytes, so that repeated calls
+        with identical inputs do not reload them from disk. Results
+        returned from memory are read-only. Only cached results are kept:
+        memory_level must be 2 for the transformed data. Images are
+        identified by their filename and modification time, or, if they
+        are given as objects, by their identity: they must not be
+        modified in place.
+
     verbose: interger, optional
         Indicate the level of verbosity. By default, nothing is printed
 
@@ -114,6 +134,8 @@ class NiftiMasker(BaseMasker, CacheMixin):
                  mask_connected=True, mask_opening=False,
                  mask_lower_cutoff=0.2, mask_upper_cutoff=0.9,
                  memory_level=0, memory=Memory(cachedir=None),
+                 memory_mmap_mode=None, memory_max_bytes=None,
+                 memory_ram_max_bytes=None,
                  verbose=0
                  ):
         # Mask is compulsory or computed
@@ -134,6 +156,9 @@ class NiftiMasker(BaseMasker, CacheMixin):
 
         self.memory = memory
         self.memory_level = memory_level
+        self.memory_mmap_mode = memory_mmap_mode
+        self.memory_max_bytes = memory_max_bytes
+        self.memory_ram_max_bytes = memory_ram_max_bytes
         self.verbose = verbose
 
     def fit(self, niimgs=None, y=None):
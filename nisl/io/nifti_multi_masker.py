@@ -6,9 +6,12 @@ Transformer used to apply basic transformations on multi subject MRI data.
 
 import warnings
 import collections
+import itertools
+import sys
+import threading
 
 import numpy as np
-from sklearn.externals.joblib import Memory
+from sklearn.externals.joblib import Memory, Parallel, delayed
 
 from nibabel import Nifti1Image
 
@@ -17,6 +20,78 @@ from .. import resampling
 from .. import utils
 from ..utils import CacheMixin
 from .base_masker import BaseMasker
+from .masked_data_store import MaskedDataStore
+
+
+def _transform_single_niimgs(masker, niimg, confounds=None, store=None,
+                             index=None):
+    """ Transform the data of one subject, return it along with its affine.
+
+    If store, the path of a MaskedDataStore, is given, the data is written
+    in the store at the given subject index and None is returned instead.
+
+    This is a function, rather than a method, so that it can be dispatched
+    to joblib workers.
+    """
+    # If we have a string (filename), we won't need to copy, as
+    # there will be no side effect
+    copy = not isinstance(niimg, basestring)
+    data = masker.transform_single_niimgs(niimg, confounds=confounds,
+                                          copy=copy)
+    if store is not None:
+        store = MaskedDataStore(store, mmap_mode='r+')
+        store[index][...] = data
+        store.flush()
+        data = None
+    return data, masker.affine_
+
+
+def _get_n_scans(niimg):
+    """ Return the number of scans of a 4D niimg or of a list of 3D niimgs
+        without loading the data if possible.
+    """
+    if hasattr(niimg, '__iter__') and not isinstance(niimg, basestring):
+        return len(niimg)
+    return utils._get_shape(utils.check_niimg(niimg))[3]
+
+
+def _get_affine(niimg):
+    """ Return the affine of a 4D niimg or of a list of 3D niimgs, read
+        from the header without loading the data if possible.
+    """
+    if hasattr(niimg, '__iter__') and not isinstance(niimg, basestring):
+        niimg = iter(niimg).next()
+    return utils.check_niimg(niimg).get_affine()
+
+
+class _NiimgsLoader(threading.Thread):
+    """ Load the data of one subject in a background thread.
+    """
+
+    def __init__(self, niimg):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.niimg = niimg
+        self._loaded = None
+        self._exc_info = None
+        self.start()
+
+    def run(self):
+        try:
+            niimg = utils.check_niimgs(self.niimg)
+            # Force the data to be read from the disk
+            niimg.get_data()
+            self._loaded = niimg
+        except:
+            self._exc_info = sys.exc_info()
+
+    def get(self):
+        """ Wait for the data to be loaded, and return it
+        """
+        self.join()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._loaded
 
 
 class NiftiMultiMasker(BaseMasker, CacheMixin):
@@ -86,9 +161,31 @@ class NiftiMultiMasker(BaseMasker, CacheMixin):
         Rough estimator of the amount of memory used by caching. Higher value
         means more memory for caching.
 
+    memory_mmap_mode: {None, 'r+', 'r', 'w+', 'c'}, optional
+        Memmapping mode used to load arrays from the cache, e.g. 'r' to
+        memory-map them instead of reading them in full. If None, cached
+        results are entirely loaded in memory.
+
+    memory_max_bytes: integer, optional
+        Maximum size of the cache directory, in bytes. When it is exceeded,
+        least recently used results are evicted. By default, the cache
+        grows without bound.
+
+    memory_ram_max_bytes: integer, optional
+        If given, the most recently used cached results are additionally
+        kept in memory, up to this number of bytes, so that repeated calls
+        with identical inputs do not reload them from disk. Results
+        returned from memory are read-only. Only cached results are kept:
+        memory_level must be 2 for the transformed data. Images are
+        identified by their filename and modification time, or, if they
+        are given as objects, by their identity: they must not be
+        modified in place.
+
     n_jobs: integer, optional
         The number of CPUs to use to do the computation. -1 means
-        'all CPUs', -2 'all CPUs but one', and so on.
+        'all CPUs', -2 'all CPUs but one', and so on. Both the mask
+        computation and the transformation of the subjects are done in
+        parallel. At most n_jobs subjects are processed at a time.
 
     verbose: interger, optional
         Indicate the level of verbosity. By default, nothing is printed
@@ -119,6 +216,8 @@ class NiftiMultiMasker(BaseMasker, CacheMixin):
                  mask_connected=True, mask_opening=False,
                  mask_lower_cutoff=0.2, mask_upper_cutoff=0.9,
                  memory=Memory(cachedir=None), memory_level=0,
+                 memory_mmap_mode=None, memory_max_bytes=None,
+                 memory_ram_max_bytes=None,
                  n_jobs=1, verbose=0
                  ):
         # Mask is provided or computed
@@ -138,6 +237,9 @@ class NiftiMultiMasker(BaseMasker, CacheMixin):
 
         self.memory = memory
         self.memory_level = memory_level
+        self.memory_mmap_mode = memory_mmap_mode
+        self.memory_max_bytes = memory_max_bytes
+        self.memory_ram_max_bytes = memory_ram_max_bytes
         self.n_jobs = n_jobs
         self.verbose = verbose
 
@@ -205,7 +307,7 @@ class NiftiMultiMasker(BaseMasker, CacheMixin):
 
         return self
 
-    def transform(self, niimgs, confounds=None):
+    def transform(self, niimgs, confounds=None, store=None):
         """ Apply mask, spatial and temporal preprocessing
 
         Parameters
@@ -217,30 +319,127 @@ class NiftiMultiMasker(BaseMasker, CacheMixin):
             This parameter is passed to signals.clean. Please see the
             corresponding documentation for details.
 
+        store: string, optional
+            If given, the preprocessed data of all the subjects is written
+            directly in a MaskedDataStore created in this directory,
+            instead of being returned as a list of arrays.
+
         Returns
         -------
-        data: {list of numpy arrays}
+        data: {list of numpy arrays} or MaskedDataStore
             preprocessed images
         """
-        data = []
-        affine = None
-        for index, niimg in enumerate(niimgs):
-            # If we have a string (filename), we won't need to copy, as
-            # there will be no side effect
-            copy = not isinstance(niimg, basestring)
-            niimg = utils.check_niimgs(niimg)
+        if not hasattr(self, 'mask_img_'):
+            raise ValueError('It seems that %s has not been fit. '
+                "You must call fit() before calling transform()."
+                % self.__class__.__name__)
+        niimgs = list(niimgs)
+        if not niimgs:
+            return []
+        if confounds is None:
+            confounds = [None] * len(niimgs)
+        elif len(confounds) != len(niimgs):
+            raise ValueError('%i confounds were given for %i subjects: '
+                             'one is needed per subject.'
+                             % (len(confounds), len(niimgs)))
+        if self.target_affine is None:
+            # Subjects that have a different affine than the first one are
+            # resampled on it. The affines are read from the headers, so
+            # that the subjects are dispatched with the right target.
+            affine = _get_affine(niimgs[0])
+            if any(np.any(_get_affine(niimg) != affine)
+                   for niimg in niimgs[1:]):
+                warnings.warn('Affine is different across subjects.'
+                              ' Realignement on first subject affine forced')
+                self.target_affine = affine
+        if store is not None:
+            MaskedDataStore.create(store,
+                                   [_get_n_scans(niimg) for niimg in niimgs],
+                                   self.mask_img_)
+        results = self._transform_niimgs(niimgs, confounds, store=store)
+        self.affine_ = results[0][1]
+        if store is not None:
+            return MaskedDataStore(store)
+        return [data for data, _ in results]
+
+    def iter_transform(self, niimgs, confounds=None):
+        """ Apply mask, spatial and temporal preprocessing, one subject at
+        a time
+
+        Unlike transform, only the data of the subject being processed and
+        of the next one, which is loaded in the background, are held in
+        memory.
+
+        Parameters
+        ----------
+        niimgs: iterable of nifti-like images
+            Data to be preprocessed
+
+        confounds: list of CSV file paths or 2D matrices, optional
+            This parameter is passed to signals.clean. Please see the
+            corresponding documentation for details.
 
-            if affine is not None and np.all(niimg.get_affine() != affine):
+        Returns
+        -------
+        iterator of (index, data) pairs, where data is the preprocessed
+        numpy array of the index-th subject.
+        """
+        if not hasattr(self, 'mask_img_'):
+            raise ValueError('It seems that %s has not been fit. '
+                "You must call fit() before calling transform()."
+                % self.__class__.__name__)
+        if confounds is None:
+            confounds = itertools.repeat(None)
+        niimgs = iter(niimgs)
+        confounds = iter(confounds)
+        try:
+            loader = _NiimgsLoader(niimgs.next())
+        except StopIteration:
+            return
+        affine = None
+        index = 0
+        while loader is not None:
+            niimg = loader.niimg
+            loaded_niimg = loader.get()
+            # Prefetch the next subject while this one is processed
+            try:
+                loader = _NiimgsLoader(niimgs.next())
+            except StopIteration:
+                loader = None
+
+            if affine is not None and np.any(
+                    loaded_niimg.get_affine() != affine):
                 warnings.warn('Affine is different across subjects.'
                               ' Realignement on first subject affine forced')
                 self.target_affine = affine
-            if confounds is not None:
-                data.append(self.transform_single_niimgs(
-                    niimg, confounds=confounds[index],
-                    copy=copy))
-            else:
-                data.append(self.transform_single_niimgs(niimg,
-                                                         copy=copy))
+            try:
+                this_confounds = confounds.next()
+            except StopIteration:
+                raise ValueError('Not enough confounds were given: '
+                                 'one is needed per subject.')
+            # If we have a string (filename), we won't need to copy, as
+            # there will be no side effect
+            data = self.transform_single_niimgs(
+                loaded_niimg, confounds=this_confounds,
+                copy=not isinstance(niimg, basestring))
+            del loaded_niimg
             if affine is None:
                 affine = self.affine_
-        return data
+            yield index, data
+            index += 1
+
+    def _transform_niimgs(self, niimgs, confounds, store=None):
+        """ Transform the subjects in parallel, in order.
+
+        Returns a list of (data, affine) pairs. If store is given, the data
+        is written in the store, and data is None.
+        """
+        # Dispatching only n_jobs subjects at a time bounds the number of
+        # subjects loaded in memory
+        return Parallel(n_jobs=self.n_jobs, pre_dispatch='n_jobs',
+                        verbose=max(0, self.verbose - 1))(
+            delayed(_transform_single_niimgs)(self, niimg,
+                                              confounds=this_confounds,
+                                              store=store, index=index)
+            for index, (niimg, this_confounds)
+            in enumerate(zip(niimgs, confounds)))
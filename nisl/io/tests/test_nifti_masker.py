@@ -8,11 +8,18 @@ test_signal.py for this.
 # Author: Gael Varoquaux, Philippe Gervais
 # License: simplified BSD
 
-from nose.tools import assert_true, assert_false, assert_raises
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_true, assert_false, assert_raises, assert_equal
 import numpy as np
 
+import nibabel
 from nibabel import Nifti1Image
 
+from ... import masking
+from ... import utils
 from ..nifti_masker import NiftiMasker
 
 
@@ -128,3 +135,40 @@ def test_matrix_orientation():
     timeseries = masker.transform(fmri)
     recovered = masker.inverse_transform(timeseries)
     np.testing.assert_array_almost_equal(recovered.get_data(), fmri.get_data())
+
+
+def test_ram_cache():
+    # Results kept in memory are found without loading and masking the
+    # images again
+    fmri, mask = generate_fake_fmri(length=5)
+    apply_mask = masking.apply_mask
+    n_calls = [0]
+
+    def counting_apply_mask(*args, **kwargs):
+        n_calls[0] += 1
+        return apply_mask(*args, **kwargs)
+
+    tmpdir = tempfile.mkdtemp()
+    masking.apply_mask = counting_apply_mask
+    try:
+        utils._ram_caches.clear()
+        masker = NiftiMasker(mask=mask, detrend=True, memory_level=2,
+                             memory_ram_max_bytes=10 ** 7).fit()
+        timeseries = masker.transform(fmri)
+        np.testing.assert_array_equal(masker.transform(fmri), timeseries)
+        assert_equal(n_calls[0], 1)
+        assert_equal(masker.cache_info()['_filter_and_mask']['ram_hits'], 1)
+        # Files are identified by their modification time
+        filename = os.path.join(tmpdir, 'fmri.nii')
+        nibabel.save(fmri, filename)
+        np.testing.assert_array_equal(masker.transform(filename), timeseries)
+        masker.transform(filename)
+        assert_equal(n_calls[0], 2)
+        mtime = os.path.getmtime(filename) + 10
+        os.utime(filename, (mtime, mtime))
+        masker.transform(filename)
+        assert_equal(n_calls[0], 3)
+    finally:
+        masking.apply_mask = apply_mask
+        utils._ram_caches.clear()
+        shutil.rmtree(tmpdir, ignore_errors=True)
@@ -4,6 +4,9 @@ Test the nifti_multi_masker module
 # Author: Gael Varoquaux
 # License: simplified BSD
 
+import shutil
+import tempfile
+
 from nose.tools import assert_true, assert_false, assert_raises
 import numpy as np
 from numpy.testing import assert_array_equal
@@ -11,6 +14,7 @@ from numpy.testing import assert_array_equal
 from nibabel import Nifti1Image
 
 from ..nifti_multi_masker import NiftiMultiMasker
+from ..masked_data_store import MaskedDataStore
 
 
 def test_auto_mask():
@@ -59,3 +63,100 @@ def test_nan():
     assert_false(mask[-1].any())
     assert_false(mask[:, -1].any())
     assert_false(mask[:, :, -1].any())
+
+
+def test_parallel_transform():
+    rng = np.random.RandomState(0)
+    mask = np.zeros((9, 9, 9))
+    mask[2:-2, 2:-2, 2:-2] = 1
+    mask_img = Nifti1Image(mask, np.eye(4))
+    imgs = [Nifti1Image(rng.rand(9, 9, 9, 5), np.eye(4)) for _ in range(4)]
+    masker = NiftiMultiMasker(mask=mask_img, detrend=True).fit()
+    data = masker.transform(imgs)
+    masker_parallel = NiftiMultiMasker(mask=mask_img, detrend=True,
+                                       n_jobs=2).fit()
+    data_parallel = masker_parallel.transform(imgs)
+    # Results are returned in the order of the subjects
+    assert_true(len(data_parallel) == len(imgs))
+    for this_data, this_data_parallel in zip(data, data_parallel):
+        assert_array_equal(this_data, this_data_parallel)
+    assert_array_equal(masker_parallel.affine_, np.eye(4))
+    assert_true(masker_parallel.transform([]) == [])
+    # Subjects are not silently dropped when confounds are missing
+    assert_raises(ValueError, masker_parallel.transform, imgs,
+                  confounds=[None] * (len(imgs) - 1))
+
+
+def test_transform_misaligned():
+    # A subject on a different grid is resampled on the first one
+    rng = np.random.RandomState(0)
+    mask = np.zeros((9, 9, 9))
+    mask[2:-2, 2:-2, 2:-2] = 1
+    imgs = [Nifti1Image(rng.rand(9, 9, 9, 5), np.eye(4)),
+            Nifti1Image(rng.rand(17, 17, 17, 5), np.diag([.5, .5, .5, 1]))]
+    masker = NiftiMultiMasker(mask=Nifti1Image(mask, np.eye(4)),
+                              n_jobs=2).fit()
+    data = masker.transform(imgs)
+    assert_array_equal(masker.target_affine, np.eye(4))
+    for this_data in data:
+        assert_array_equal(this_data.shape, (5, 125))
+
+
+def test_iter_transform():
+    rng = np.random.RandomState(0)
+    mask = np.zeros((9, 9, 9))
+    mask[2:-2, 2:-2, 2:-2] = 1
+    masker = NiftiMultiMasker(mask=Nifti1Image(mask, np.eye(4)),
+                              standardize=True).fit()
+    imgs = [Nifti1Image(rng.rand(9, 9, 9, 5), np.eye(4)) for _ in range(3)]
+    data = masker.transform(imgs)
+    n_subjects = 0
+    for index, this_data in masker.iter_transform(iter(imgs)):
+        assert_array_equal(this_data, data[index])
+        n_subjects += 1
+    assert_true(n_subjects == len(imgs))
+    assert_true(list(masker.iter_transform([])) == [])
+    assert_raises(ValueError, list,
+                  masker.iter_transform(imgs, confounds=[None, None]))
+
+    # A subject on a different grid is resampled on the first one, as in
+    # transform
+    imgs = [Nifti1Image(rng.rand(9, 9, 9, 5), np.eye(4)),
+            Nifti1Image(rng.rand(17, 17, 17, 5), np.diag([.5, .5, .5, 1]))]
+    data = NiftiMultiMasker(mask=Nifti1Image(mask, np.eye(4))).fit(
+        ).transform(imgs)
+    masker = NiftiMultiMasker(mask=Nifti1Image(mask, np.eye(4))).fit()
+    for index, this_data in masker.iter_transform(imgs):
+        assert_array_equal(this_data, data[index])
+    assert_array_equal(masker.target_affine, np.eye(4))
+
+
+def test_transform_to_store():
+    rng = np.random.RandomState(0)
+    mask = np.zeros((9, 9, 9))
+    mask[2:-2, 2:-2, 2:-2] = 1
+    mask_img = Nifti1Image(mask, np.eye(4))
+    imgs = [Nifti1Image(rng.rand(9, 9, 9, n_scans), np.eye(4))
+            for n_scans in (5, 3, 4)]
+    masker = NiftiMultiMasker(mask=mask_img, n_jobs=2).fit()
+    data = masker.transform(imgs)
+    store_dir = tempfile.mkdtemp()
+    try:
+        store = masker.transform(imgs, store=store_dir)
+        assert_true(isinstance(store, MaskedDataStore))
+        # The store can be reopened
+        store = MaskedDataStore(store_dir)
+        assert_true(len(store) == len(imgs))
+        assert_array_equal(store.offsets, [0, 5, 8, 12])
+        assert_array_equal(store.mask_img_.get_data(), mask)
+        for this_data, stored_data in zip(data, store):
+            assert_array_equal(this_data, stored_data)
+        # Slicing returns views on the file
+        assert_true(isinstance(store[1], np.memmap))
+        assert_array_equal(store.get_voxels(2, 10, subject=2),
+                           data[2][:, 2:10])
+        assert_array_equal(store.get_voxels(2, 10),
+                           np.concatenate(data)[:, 2:10])
+        assert_raises(IndexError, store.__getitem__, 3)
+    finally:
+        shutil.rmtree(store_dir, ignore_errors=True)
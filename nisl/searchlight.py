@@ -3,19 +3,32 @@
 #
 #License: BSD 3 clause
 
+import os
+import itertools
+import json
+import multiprocessing
+import shutil
+import tempfile
 import numpy as np
 import time
 import sys
-from sklearn.externals.joblib import Parallel, delayed, cpu_count
+from scipy import ndimage, sparse
+from sklearn.externals.joblib import cpu_count, hash
 
 from sklearn.svm import LinearSVC
-from sklearn.cross_validation import cross_val_score
-from sklearn.base import BaseEstimator
-from sklearn import neighbors
+from sklearn.cross_validation import check_cv
+from sklearn.base import BaseEstimator, clone, is_classifier
+from sklearn.lda import LDA
+from sklearn.linear_model import RidgeClassifier
+from sklearn.utils import check_random_state
+
+from .utils import _dump_shared, _load_shared
 
 
 def search_light(X, y, estimator, A, score_func=None, cv=None, n_jobs=-1,
-                 verbose=0):
+                 verbose=0, batch_size=None, largest_first=True,
+                 temp_folder=None, checkpoint=None, n_permutations=0,
+                 random_state=None, progress=None):
     """Function for computing a search_light
 
     Parameters
@@ -26,12 +39,16 @@ def search_light(X, y, estimator, A, score_func=None, cv=None, n_jobs=-1,
     y: array-like
         The target variable to try to predict.
 
-    estimator: estimator object implementing 'fit'
-        The object to use to fit the data
+    estimator: estimator object implementing 'fit', or string
+        The object to use to fit the data. LDA and RidgeClassifier
+        instances, as well as the strings 'lda', 'ridge' and 'correlation'
+        (nearest class mean with correlation distance), are run by a
+        vectorized engine that scores many spheres at once.
 
     A : sparse matrix.
         adjacency matrix. Defines for each sample the neigbhoring samples
-        following a given structure of the data.
+        following a given structure of the data. It is converted to CSR
+        format; see sphere_adjacency.
 
     score_func: callable, optional
         callable taking as arguments the fitted estimator, the
@@ -48,21 +65,461 @@ def search_light(X, y, estimator, A, score_func=None, cv=None, n_jobs=-1,
         'all CPUs'.
 
     verbose: integer, optional
-        The verbosity level. Defaut is 0
+        The verbosity level. Defaut is 0. If positive, a progress line is
+        printed each time a batch is done.
+
+    batch_size: integer, optional
+        Number of voxels processed by a job. The voxels are split in many
+        small batches that are dispatched to the CPUs as they become idle,
+        which balances the load when sphere sizes or fit times vary. By
+        default, each CPU receives about 16 batches.
+
+    largest_first: boolean, optional
+        If True, batches with the largest spheres are dispatched first, so
+        that the CPUs do not wait on a long batch at the end of the run.
+
+    temp_folder: string, optional
+        When several jobs are used, X and y are written once in this
+        folder and memory-mapped by the workers, instead of being copied
+        to each of them. A folder on a RAM-backed file system, such as
+        /dev/shm, makes this a shared-memory segment. Defaults to the
+        system temporary folder.
+
+    checkpoint: string, optional
+        Folder in which the scores are saved as they are computed, along
+        with the list of the voxels already processed. If the folder holds
+        the checkpoint of an interrupted run with the same data,
+        estimator, score function, adjacency, cross-validation and labels,
+        only the remaining voxels are processed, with the permutations of
+        the interrupted run. The data is identified by its shape, dtype
+        and a sample of its values. The folder is kept at the end of the
+        run.
+
+    n_permutations: integer, optional
+        Number of permutations of y used to compute p-values. The true and
+        permuted labels are evaluated together on each sphere, so that the
+        data of the sphere is extracted only once. With a ridge model, all
+        the labelings are fitted as a single multi-output problem.
+
+    random_state: int or RandomState, optional
+        Pseudo number generator state used to permute y.
+
+    progress: callable or string, optional
+        Receives a progress report each time a batch is done. A callable
+        is called with the report, a dict; a string is the name of a file
+        to which the report is appended as a line of JSON. See
+        _report_progress for the content of the report. Reporting progress
+        does not change the scheduling of the batches.
 
     Returns
     -------
     scores: array-like of shape (number of rows in A)
-        search_light scores
+        search_light scores. Empty spheres, i.e. empty rows of A, have a
+        NaN score.
+
+    pvalues: array-like of shape (number of rows in A)
+        Only returned if n_permutations > 0. Permutation p-value of the
+        score of each sphere: the fraction of the permutations, counting
+        the true labels, that score at least as high. NaN for empty
+        spheres.
     """
-    scores = np.zeros(len(A.rows), dtype=float)
-    group_iter = GroupIterator(A.shape[0], n_jobs)
-    scores = Parallel(n_jobs=n_jobs, verbose=verbose)(
-        delayed(_group_iter_search_light)(
-            list_i, A.rows[list_i],
-            estimator, X, y, A.shape[0], score_func, cv, verbose)
-        for list_i in group_iter)
-    return np.concatenate(scores)
+    A = sparse.csr_matrix(A)
+    n_voxels = A.shape[0]
+    linear_method = _get_linear_method(estimator)
+    y = np.asarray(y)
+    # The splits are computed once, and shared by all the spheres
+    folds = _get_folds(cv, X, y, classifier=(linear_method is not None
+                                             or is_classifier(estimator)))
+    # The true labels, followed by the permuted ones
+    random_state = check_random_state(random_state)
+    labelings = np.array([y] + [random_state.permutation(y)
+                                for _ in range(n_permutations)])
+    if checkpoint is None:
+        scores = np.zeros((len(labelings), n_voxels), dtype=float)
+        done = np.zeros(n_voxels, dtype=np.bool)
+    else:
+        key = _checkpoint_key(X, y, estimator, A, score_func, folds,
+                              n_permutations)
+        scores, done, labelings = _open_checkpoint(checkpoint, key,
+                                                   labelings, n_voxels)
+    # Only the voxels that are not in the checkpoint are processed
+    todo = np.where(np.logical_not(done))[0]
+    if len(todo) == 0:
+        return _search_light_results(np.array(scores))
+
+    if n_jobs < 0:
+        n_cpus = max(1, cpu_count() + 1 + n_jobs)
+    else:
+        n_cpus = n_jobs
+    if batch_size is None:
+        batch_size = max(1, int(np.ceil(len(todo) / (16. * n_cpus))))
+    costs = None
+    if largest_first:
+        costs = np.diff(A.indptr)[todo]
+    group_iter = GroupIterator(len(todo), n_jobs, batch_size=batch_size,
+                               costs=costs)
+    batches = [todo[list_i] for list_i in group_iter if len(list_i)]
+    # Daemonic processes, such as joblib workers, cannot start a pool: the
+    # batches are then run sequentially
+    parallel = (n_cpus > 1 and len(batches) > 1
+                and not multiprocessing.current_process().daemon)
+    sizes = np.diff(A.indptr)
+    busy_times = dict()
+    n_processed = 0
+    t0 = time.time()
+
+    temp_dir = None
+    if parallel:
+        # Workers memory-map the data instead of receiving a pickled copy
+        temp_dir = tempfile.mkdtemp(prefix='nisl_searchlight_',
+                                    dir=temp_folder)
+        X = _dump_shared(X, os.path.join(temp_dir, 'X.npy'))
+        labelings = _dump_shared(labelings, os.path.join(temp_dir, 'y.npy'))
+    if linear_method is not None:
+        method, alpha = linear_method
+        jobs = ((list_i, _group_iter_linear_search_light,
+                 (_get_rows(A, list_i), method, alpha, X, labelings, folds,
+                  score_func))
+                for list_i in batches)
+    else:
+        jobs = ((list_i, _group_iter_search_light,
+                 (_get_rows(A, list_i), estimator, X, labelings, score_func,
+                  folds))
+                for list_i in batches)
+    pool = None
+    try:
+        if parallel:
+            # A single pool runs all the batches: they are dispatched, in
+            # order, to the workers as they become idle, and collected as
+            # they complete
+            pool = multiprocessing.Pool(min(n_cpus, len(batches)))
+            results = _interruptible(pool.imap_unordered(_run_batch, jobs))
+        else:
+            results = itertools.imap(_run_batch, jobs)
+        for list_i, (this_scores, stats) in results:
+            scores[:, list_i] = this_scores
+            done[list_i] = True
+            busy_times[stats['pid']] = (busy_times.get(stats['pid'], 0)
+                                        + stats['time'])
+            n_processed += stats['n_spheres']
+            if checkpoint is not None:
+                scores.flush()
+                done.flush()
+            if progress is not None or verbose > 0:
+                _report_progress(progress, verbose, done, sizes,
+                                 n_processed, busy_times, time.time() - t0)
+        if pool is not None:
+            pool.close()
+            pool.join()
+            pool = None
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    if checkpoint is not None:
+        scores = np.array(scores)
+    return _search_light_results(scores)
+
+
+def _run_batch(job):
+    """ Run a batch of search_light. job is a (voxels, function, arguments)
+        tuple: the batch function is called with the arguments, and its
+        result is returned with the voxels of the batch.
+    """
+    list_i, func, args = job
+    return list_i, func(*args)
+
+
+def _interruptible(results, timeout=1.):
+    """ Iterate over the results of Pool.imap_unordered.
+
+        Waiting for a result without a timeout blocks KeyboardInterrupt
+        until the result arrives: the wait is split in short ones.
+    """
+    while True:
+        try:
+            yield results.next(timeout)
+        except multiprocessing.TimeoutError:
+            continue
+        except StopIteration:
+            return
+
+
+def _search_light_results(scores):
+    """ Return the scores of the true labels, the first row of scores,
+        and, if scores has other rows, the permutation p-values.
+    """
+    n_permutations = len(scores) - 1
+    if n_permutations == 0:
+        return scores[0]
+    # Empty spheres have NaN scores, and p-values
+    with np.errstate(invalid='ignore'):
+        pvalues = ((1. + (scores[1:] >= scores[0]).sum(axis=0))
+                   / (n_permutations + 1))
+    pvalues[np.isnan(scores[0])] = np.nan
+    return scores[0], pvalues
+
+
+def _get_rows(A, list_i):
+    """ Return the column indices of the given rows of a CSR matrix.
+    """
+    return [A.indices[A.indptr[i]:A.indptr[i + 1]] for i in list_i]
+
+
+def _sphere_offsets(radius, affine=None):
+    """ Offsets, on the voxel grid, of the voxels of a sphere: (3, n_voxels)
+        array.
+
+        The radius is in voxels if affine is None, and in the units of the
+        affine (usually mm) otherwise.
+    """
+    if affine is None:
+        linear = np.eye(3)
+    else:
+        linear = np.asarray(affine)[:3, :3]
+    # Extent of the sphere along each axis of the voxel grid
+    inv_linear = np.linalg.inv(linear)
+    extents = np.floor(radius * np.sqrt((inv_linear ** 2).sum(axis=1)))
+    extents = extents.astype(np.int)
+    grid = np.mgrid[tuple(slice(-extent, extent + 1) for extent in extents)]
+    grid = grid.reshape(3, -1)
+    # Small tolerance so that voxels exactly on the sphere are kept
+    distances = np.sqrt((np.dot(linear, grid) ** 2).sum(axis=0))
+    return grid[:, distances <= radius * (1 + 1e-10)]
+
+
+def sphere_adjacency(mask, process_mask, radius, affine=None):
+    """ Compute the voxels of the searchlight sphere around each voxel
+
+    The sphere is computed once as a stencil of offsets on the voxel grid,
+    and applied to each center by indexing a padded volume of voxel
+    indices.
+
+    Parameters
+    ----------
+    mask: 3D boolean array
+        The voxels that can belong to a sphere.
+
+    process_mask: 3D boolean array
+        The centers of the spheres.
+
+    radius: float
+        Radius of the spheres, in voxels if affine is None, in the units
+        of the affine (usually mm) otherwise.
+
+    affine: 4x4 or 3x3 array, optional
+        Affine of the mask. If given, distances are measured in world space,
+        which accounts for anisotropic voxels.
+
+    Returns
+    -------
+    A: scipy.sparse.csr_matrix of shape (n_process_voxels, n_mask_voxels)
+        Row i holds the indices, in the mask, of the voxels of the sphere
+        centered on the i-th process_mask voxel. Centers that are in the
+        mask belong to their sphere. Indices and index pointers are int32.
+    """
+    mask = np.asarray(mask) != 0
+    process_mask = np.asarray(process_mask) != 0
+    offsets = _sphere_offsets(radius, affine)
+    extents = np.abs(offsets).max(axis=1)
+    # Index of each mask voxel, -1 outside the mask, in a volume padded so
+    # that spheres never wrap around its edges
+    padded_shape = np.array(mask.shape) + 2 * extents
+    indices_volume = -np.ones(padded_shape, dtype=np.int32)
+    inner = [slice(extent, extent + size)
+             for extent, size in zip(extents, mask.shape)]
+    indices_volume[tuple(inner)][mask] = np.arange(mask.sum(),
+                                                   dtype=np.int32)
+    indices_volume = indices_volume.ravel()
+    strides = np.array([padded_shape[1] * padded_shape[2],
+                        padded_shape[2], 1])
+    kernel = np.sort(np.dot(strides, offsets))
+
+    centers = np.array(np.where(process_mask)) + extents[:, np.newaxis]
+    centers = np.dot(strides, centers)
+    indptr = np.zeros(len(centers) + 1, dtype=np.int32)
+    indices = []
+    # Process the centers in chunks to bound the memory usage
+    chunk_size = max(1, 2 ** 20 // len(kernel))
+    for start in range(0, len(centers), chunk_size):
+        neighbors = indices_volume[centers[start:start + chunk_size,
+                                           np.newaxis] + kernel]
+        in_mask = neighbors >= 0
+        indices.append(neighbors[in_mask])
+        indptr[start + 1:start + 1 + len(neighbors)] = in_mask.sum(axis=1)
+    indptr = np.cumsum(indptr).astype(np.int32)
+    if indices:
+        indices = np.concatenate(indices)
+    else:
+        indices = np.zeros(0, dtype=np.int32)
+    return sparse.csr_matrix((np.ones(len(indices), dtype=np.int8),
+                              indices, indptr),
+                             shape=(len(centers), mask.sum()))
+
+
+def _fingerprint(X, n_values=10000):
+    """ Shape, dtype and hash of a regular sample of n_values values of X,
+        that identify the data without reading all of it.
+    """
+    X = np.asarray(X)
+    step = max(1, X.size // n_values)
+    return X.shape, X.dtype.str, hash(np.asarray(X.flat[::step]))
+
+
+def _checkpoint_key(X, y, estimator, A, score_func, folds, n_permutations):
+    """ Hash of the inputs of a search_light run, that a checkpoint must
+        have been saved for to be resumed.
+    """
+    if not isinstance(estimator, basestring):
+        # Only the parameters of the estimator matter
+        estimator = clone(estimator)
+    return hash((_fingerprint(X), y, estimator, A.shape, A.indptr,
+                 A.indices, score_func, folds, n_permutations))
+
+
+def _open_checkpoint(path, key, labelings, n_voxels):
+    """ Open, or create, the scores and progress memmaps of a checkpoint.
+
+    Returns the scores, of shape (n_labelings, n_voxels), a boolean array
+    flagging the voxels already processed, both memory-mapped in
+    read-write mode, and the labelings. The labelings are saved when the
+    checkpoint is created, and loaded when it is resumed, so that the
+    permutations do not change.
+    """
+    scores_file = os.path.join(path, 'scores.npy')
+    done_file = os.path.join(path, 'done.npy')
+    labelings_file = os.path.join(path, 'labelings.npy')
+    key_file = os.path.join(path, 'key.txt')
+    if os.path.exists(key_file):
+        with open(key_file) as f:
+            previous_key = f.read().strip()
+        if previous_key != key:
+            raise ValueError('The checkpoint in %s was saved for different '
+                             'data, estimator, score function, adjacency, '
+                             'cross-validation or labels. Remove it or use '
+                             'another folder.' % path)
+        scores = np.load(scores_file, mmap_mode='r+')
+        done = np.load(done_file, mmap_mode='r+')
+        labelings = np.load(labelings_file)
+    else:
+        if not os.path.exists(path):
+            os.makedirs(path)
+        np.save(labelings_file, labelings)
+        scores = np.lib.format.open_memmap(
+            scores_file, mode='w+', dtype=np.float,
+            shape=(len(labelings), n_voxels))
+        done = np.lib.format.open_memmap(done_file, mode='w+',
+                                         dtype=np.bool, shape=(n_voxels,))
+        scores.flush()
+        done.flush()
+        # The key is written last: a checkpoint without key is incomplete
+        with open(key_file, 'w') as f:
+            f.write(key)
+    return scores, done, labelings
+
+
+def _worker_stats(t0, n_spheres):
+    """ Timing of a batch processed by a search_light worker started at t0.
+    """
+    return dict(pid=os.getpid(), time=time.time() - t0, n_spheres=n_spheres)
+
+
+def _report_progress(progress, verbose, done, sizes, n_processed,
+                     busy_times, elapsed):
+    """ Report the progress of a search_light run.
+
+    The report is a dict with the following keys:
+
+        n_done: number of voxels whose score is computed, including the
+            ones loaded from a checkpoint
+        n_voxels: total number of voxels
+        elapsed: seconds since the beginning of the run
+        voxels_per_second: voxels processed per second during the run
+        remaining: estimated number of seconds to the end of the run
+        mean_fit_time: mean worker time spent on a sphere, in seconds
+        worker_utilization: fraction of the elapsed time each worker, named
+            by its process id, spent processing batches
+        sphere_sizes: pairs of (size, number of spheres) of the spheres
+            processed so far
+
+    Parameters
+    ----------
+    progress: callable, string or None
+        Callable receiving the report, or file to which it is appended as
+        a line of JSON.
+
+    verbose: integer
+        If positive, a summary is printed on stderr.
+    """
+    elapsed = max(elapsed, 1e-6)
+    n_done = int(done.sum())
+    voxels_per_second = n_processed / elapsed
+    remaining = (len(done) - n_done) / max(voxels_per_second, 1e-6)
+    size_counts = np.bincount(sizes[done])
+    size_histogram = [(int(size), int(size_counts[size]))
+                      for size in np.where(size_counts)[0]]
+    report = dict(
+        n_done=n_done, n_voxels=len(done), elapsed=elapsed,
+        voxels_per_second=voxels_per_second, remaining=remaining,
+        mean_fit_time=sum(busy_times.values()) / max(n_processed, 1),
+        worker_utilization=dict((str(pid), busy / elapsed)
+                                for pid, busy in busy_times.items()),
+        sphere_sizes=size_histogram)
+    if verbose > 0:
+        sys.stderr.write("[search_light] processed %d/%d voxels "
+                         "(%.1f voxels/s, %i seconds remaining)\n"
+                         % (n_done, len(done), voxels_per_second,
+                            remaining))
+    if isinstance(progress, basestring):
+        with open(progress, 'a') as f:
+            f.write(json.dumps(report) + '\n')
+    elif progress is not None:
+        progress(report)
+    return report
+
+
+def _strided_fill(values, evaluated, stride):
+    """ Interpolate values known on a strided subset of a volume.
+
+    The values are convolved with a separable tent kernel of half-width
+    stride, and normalized by the convolution of the known locations:
+    this is a trilinear interpolation between lattice points, that uses the
+    available neighbors where some are missing.
+
+    Parameters
+    ----------
+    values: 3D array
+        Values, that are only read where evaluated is True.
+
+    evaluated: 3D boolean array
+        Locations of the known values.
+
+    stride: integer
+        Spacing of the known values.
+
+    Returns
+    -------
+    filled: 3D array
+        Interpolated values, equal to values where evaluated is True and
+        0 where no known value is close enough.
+
+    covered: 3D boolean array
+        Locations at less than stride, along each axis, from a known
+        value.
+    """
+    kernel = 1. - np.abs(np.arange(1 - stride, stride)) / float(stride)
+    weights = evaluated.astype(np.float)
+    weighted_values = np.where(evaluated, values, 0.)
+    for axis in range(3):
+        weights = ndimage.convolve1d(weights, kernel, axis=axis,
+                                     mode='constant')
+        weighted_values = ndimage.convolve1d(weighted_values, kernel,
+                                             axis=axis, mode='constant')
+    covered = weights > 1e-10
+    filled = np.zeros(values.shape)
+    filled[covered] = weighted_values[covered] / weights[covered]
+    return filled, covered
 
 
 class GroupIterator(object):
@@ -79,89 +536,400 @@ class GroupIterator(object):
     n_jobs: integer, optional
         The number of CPUs to use to do the computation. -1 means
         'all CPUs'. Defaut is 1
+
+    batch_size: integer, optional
+        Number of features of a group. If None, features are split in
+        n_jobs groups.
+
+    costs: array of shape (n_features, ), optional
+        Estimated computation cost of each feature. If given, groups are
+        yielded by decreasing total cost. Groups are always made of
+        contiguous features.
     """
-    def __init__(self, n_features, n_jobs=1):
+    def __init__(self, n_features, n_jobs=1, batch_size=None, costs=None):
         self.n_features = n_features
         if n_jobs == -1:
             n_jobs = cpu_count()
         self.n_jobs = n_jobs
+        self.batch_size = batch_size
+        self.costs = costs
 
     def __iter__(self):
-        split = np.array_split(np.arange(self.n_features), self.n_jobs)
+        if self.n_features == 0:
+            return
+        if self.batch_size is None:
+            n_groups = self.n_jobs
+        else:
+            n_groups = int(np.ceil(float(self.n_features) / self.batch_size))
+        n_groups = max(1, min(n_groups, self.n_features))
+        split = np.array_split(np.arange(self.n_features), n_groups)
+        if self.costs is not None:
+            split.sort(key=lambda list_i: self.costs[list_i].sum(),
+                       reverse=True)
         for list_i in split:
             yield list_i
 
 
-def _group_iter_search_light(list_i, list_rows, estimator, X, y, total,
-                             score_func, cv, verbose=0):
+def _fold_blocks(X, y, folds, columns):
+    """ Slice the samples of each fold into contiguous train and test blocks
+    of the given columns of X.
+
+    Returns a list of (X_train, y_train, X_test, y_test) tuples, y holding
+    one labeling per row. The columns of a sphere are then gathered from
+    these blocks, without indexing the rows of X again.
+    """
+    blocks = []
+    for train, test in folds:
+        blocks.append((X[np.ix_(train, columns)], y[:, train],
+                       X[np.ix_(test, columns)], y[:, test]))
+    return blocks
+
+
+def _group_iter_search_light(list_rows, estimator, X, y, score_func, folds):
     """Function for grouped iterations of search_light
 
     Parameters
     -----------
-    list_i: array of integers
-        Indices of voxels to be processed by the thread.
-
     list_rows: array of array of integers
-        Indices of adjacency rows corresponding to list_i voxels
+        Indices of the voxels of each sphere to process
 
     estimator: estimator object implementing 'fit'
         The object to use to fit the data
 
-    X: array-like of shape at least 2D
-        The data to fit.
+    X: array-like of shape at least 2D, or string
+        The data to fit, or the file in which it has been dumped by
+        _dump_shared.
 
-    y: array-like
-        The target variable to try to predict.
-
-    total: integer
-        Total number of voxels
+    y: array of shape (n_labelings, n_samples), or string
+        The labelings of the samples to predict, the true one first
+        followed by permutations, or the file in which they have been
+        dumped by _dump_shared.
 
     score_func: callable, optional
-        callable taking as arguments the fitted estimator, the
-        test data (X_test) and the test target (y_test) if y is
-        not None.
+        callable taking as arguments the test target (y_test) and the
+        predicted target. If None, the score method of the estimator is
+        used.
 
-    cv: cross-validation generator, optional
-        A cross-validation generator. If None, a 3-fold cross
-        validation is used or 3-fold stratified cross-validation
-        when y is supplied.
-
-    verbose: integer, optional
-        The verbosity level. Defaut is 0
+    folds: list of (train, test) arrays of integers
+        The cross-validation folds, see _get_folds.
 
     Returns
     -------
-    par_scores: array of float
-        precision of each voxel
+    par_scores: array of float of shape (n_labelings, n_voxels)
+        precision of each voxel, for each labeling
+
+    stats: dict
+        Timing of the batch, see _worker_stats
     """
-    par_scores = np.zeros(len(list_rows))
-    id = (list_i[0] + 1) / len(list_i) + 1
+    X = _load_shared(X)
+    y = np.asarray(_load_shared(y))
     t0 = time.time()
+    # Only the voxels of the spheres of the batch are sliced
+    list_rows = [np.asarray(row) for row in list_rows]
+    union, locations = _batch_locations(list_rows)
+    blocks = _fold_blocks(X, y, folds, union)
+    par_scores = np.zeros((len(y), len(list_rows)))
     for i, row in enumerate(list_rows):
-        if list_i[i] not in row:
-            row.append(list_i[i])
-        par_scores[i] = np.mean(cross_val_score(estimator, X[:, row],
-                                                y, score_func=score_func,
-                                                cv=cv, n_jobs=1))
-        if verbose > 0:
-            # One can't print less than each 100 iterations
-            step = 11 - min(verbose, 10)
-            if (i % step == 0):
-                # If there is only one job, progress information is fixed
-                if total == len(list_rows):
-                    crlf = "\r"
+        if not len(row):
+            # No voxel of the mask is in the sphere
+            par_scores[:, i] = np.nan
+            continue
+        row = locations[i, :len(row)]
+        for X_train, Y_train, X_test, Y_test in blocks:
+            # The sphere is extracted once for all the labelings
+            X_train_row = X_train[:, row]
+            X_test_row = X_test[:, row]
+            for j, (y_train, y_test) in enumerate(zip(Y_train, Y_test)):
+                this_estimator = clone(estimator)
+                this_estimator.fit(X_train_row, y_train)
+                if score_func is None:
+                    par_scores[j, i] += this_estimator.score(X_test_row,
+                                                             y_test)
                 else:
-                    crlf = "\n"
-                percent = float(i) / len(list_rows)
-                percent = round(percent * 100, 2)
-                dt = time.time() - t0
-                # We use a max to avoid a division by zero
-                remaining = (100. - percent) / max(0.01, percent) * dt
-                sys.stderr.write(
-                    "Job #%d, processed %d/%d voxels"
-                    "(%0.2f%%, %i seconds remaining)%s"
-                    % (id, i, len(list_rows), percent, remaining, crlf))
-    return par_scores
+                    par_scores[j, i] += score_func(
+                        y_test, this_estimator.predict(X_test_row))
+        par_scores[:, i] /= len(blocks)
+    return par_scores, _worker_stats(t0, len(list_rows))
+
+
+##############################################################################
+### Vectorized search_light for linear models ################################
+##############################################################################
+
+# Tolerance on the singular values of the within-class scaled data, as in
+# sklearn.lda.LDA
+_LDA_TOL = 1.0e-4
+
+
+def _get_linear_method(estimator):
+    """ Return (method, alpha) if the estimator can be run by the vectorized
+        search_light engine, None otherwise.
+    """
+    if isinstance(estimator, basestring):
+        if not estimator in ('lda', 'ridge', 'correlation'):
+            raise ValueError("Unknown search_light estimator '%s'. "
+                             "Valid strings are 'lda', 'ridge' and "
+                             "'correlation'." % estimator)
+        return estimator, 1.
+    # Subclasses may change the model, hence the strict type checks
+    if type(estimator) is LDA and estimator.priors is None:
+        return 'lda', None
+    if (type(estimator) is RidgeClassifier and estimator.fit_intercept
+            and not estimator.normalize and estimator.class_weight is None):
+        return 'ridge', estimator.alpha
+    return None
+
+
+def _get_folds(cv, X, y, classifier=True):
+    """ Return the cross-validation folds as a list of (train, test) arrays
+        of indices. If classifier is True, the default folds are
+        stratified, as in cross_val_score.
+    """
+    cv = check_cv(cv, X, y, classifier=classifier)
+    folds = []
+    for train, test in cv:
+        train = np.asarray(train)
+        test = np.asarray(test)
+        if train.dtype == np.bool:
+            train = np.where(train)[0]
+            test = np.where(test)[0]
+        folds.append((train, test))
+    return folds
+
+
+def _batch_locations(rows):
+    """ Return the union of the voxels of a batch of spheres and, for each
+        sphere, the position of its voxels in this union.
+
+        Spheres are padded to the same size with the position len(union),
+        that is meant to index a column of zeros.
+    """
+    union, inverse = np.unique(
+        np.concatenate([np.zeros(0, dtype=np.int)] + list(rows)),
+        return_inverse=True)
+    sizes = [len(row) for row in rows]
+    locations = np.empty((len(rows), max(sizes + [0])), dtype=np.int)
+    locations.fill(len(union))
+    start = 0
+    for i, size in enumerate(sizes):
+        locations[i, :size] = inverse[start:start + size]
+        start += size
+    return union, locations
+
+
+def _gather_gram(gram, locations):
+    """ Extract the diagonal blocks of each sphere from the Gram matrix of
+        the union of the voxels of a batch: (n_spheres, size, size) array.
+    """
+    return gram[locations[:, :, np.newaxis], locations[:, np.newaxis, :]]
+
+
+def _correlation_predict(X_train, y_train, X_test, classes, locations):
+    """ Nearest class mean classifier with the correlation distance.
+    """
+    padding = (locations == X_train.shape[1] - 1)
+    means = np.array([X_train[y_train == c].mean(axis=0) for c in classes])
+    # Pearson correlation between test samples and class means, across
+    # the voxels of each sphere (padding is zero and does not count).
+    n_voxels = (~padding).sum(axis=1)[:, np.newaxis, np.newaxis]
+    X = np.rollaxis(X_test[:, locations], 1)
+    M = np.rollaxis(means[:, locations], 1)
+    sxm = np.einsum('btp,bkp->btk', X, M)
+    sx = X.sum(axis=-1)[:, :, np.newaxis]
+    sm = M.sum(axis=-1)[:, np.newaxis, :]
+    vx = (X ** 2).sum(axis=-1)[:, :, np.newaxis] - sx ** 2 / n_voxels
+    vm = (M ** 2).sum(axis=-1)[:, np.newaxis, :] - sm ** 2 / n_voxels
+    corr = (sxm - sx * sm / n_voxels) / np.sqrt(vx * vm)
+    corr[~np.isfinite(corr)] = -np.inf
+    return classes[corr.argmax(axis=-1)]
+
+
+def _lda_predict(X_train, y_train, X_test, classes, locations):
+    """ Linear discriminant analysis, as in sklearn.lda.LDA.
+    """
+    n_train = X_train.shape[0]
+    padding = (locations == X_train.shape[1] - 1)
+    class_masks = [y_train == c for c in classes]
+    n_classes = len(classes)
+    means = np.array([X_train[mask].mean(axis=0) for mask in class_masks])
+    priors = np.array([mask.sum() for mask in class_masks],
+                      dtype=np.float) / n_train
+    X_centered = X_train - means[np.searchsorted(classes, y_train)]
+    gram = np.dot(X_centered.T, X_centered)
+    # Within-class scaling, as in sklearn.lda.LDA
+    std = np.sqrt(np.diag(gram) / n_train)
+    std[std == 0] = 1.
+    cov = _gather_gram(gram / np.outer(std, std), locations)
+    cov /= n_train - n_classes
+    cov[padding] = 0
+    cov.reshape(len(cov), -1)[:, ::cov.shape[1] + 1][padding] = 1.
+    # Pseudo-inverse of the within-class covariance, dropping the
+    # directions that LDA considers collinear
+    eigvals, eigvecs = np.linalg.eigh(cov)
+    inv_eigvals = np.zeros_like(eigvals)
+    nonzero = eigvals > _LDA_TOL ** 2
+    inv_eigvals[nonzero] = 1. / eigvals[nonzero]
+    xbar = np.dot(priors, means)
+    centers = (means - xbar) / std
+    centers = np.rollaxis(centers[:, locations], 1)
+    coef = np.einsum('bkp,bpq->bkq', centers, eigvecs)
+    coef *= inv_eigvals[:, np.newaxis, :]
+    coef = np.einsum('bkq,bpq->bkp', coef, eigvecs)
+    intercept = (-.5 * (coef * centers).sum(axis=-1) + np.log(priors))
+    X = (X_test - xbar) / std
+    X = np.rollaxis(X[:, locations], 1)
+    decision = np.einsum('btp,bkp->btk', X, coef)
+    decision += intercept[:, np.newaxis, :]
+    return classes[decision.argmax(axis=-1)]
+
+
+def _ridge_predict(alpha, X_train, Y_train, X_test, classes, locations):
+    """ Ridge classifier, as in sklearn.linear_model.RidgeClassifier, fitted
+        for all the labelings at once.
+
+        The regularized Gram matrix of a sphere does not depend on the
+        labels: all the labelings are solved as one multi-output problem.
+    """
+    n_labelings, n_train = Y_train.shape
+    n_classes = len(classes)
+    # One-vs-all targets in {-1, 1}, a single one for 2 classes
+    Y = -np.ones((n_train, n_labelings, n_classes))
+    for k, c in enumerate(classes):
+        Y[:, :, k][(Y_train == c).T] = 1
+    if n_classes == 2:
+        Y = Y[:, :, 1:]
+    n_targets = Y.shape[2]
+    Y = Y.reshape(n_train, -1)
+    X_mean = X_train.mean(axis=0)
+    Y_mean = Y.mean(axis=0)
+    X_centered = X_train - X_mean
+    gram = _gather_gram(np.dot(X_centered.T, X_centered), locations)
+    gram.reshape(len(gram), -1)[:, ::gram.shape[1] + 1] += alpha
+    rhs = np.dot(X_centered.T, Y - Y_mean)[locations]
+    coef = np.linalg.solve(gram, rhs)
+    X = np.rollaxis((X_test - X_mean)[:, locations], 1)
+    decision = np.einsum('btp,bpk->btk', X, coef) + Y_mean
+    decision = decision.reshape(decision.shape[:2] + (n_labelings,
+                                                      n_targets))
+    decision = np.rollaxis(decision, 2)
+    if n_classes == 2:
+        return classes[(decision[..., 0] > 0).astype(np.int)]
+    return classes[decision.argmax(axis=-1)]
+
+
+def _linear_predict(method, alpha, X_train, Y_train, X_test, locations):
+    """ Fit a linear model on each sphere of a batch and predict the
+        labels of the test samples: (n_labelings, n_spheres, n_test) array.
+
+        X_train and X_test hold the union of the voxels of the batch, with
+        an additional column of zeros used for padding. Y_train holds one
+        labeling of the train samples per row. As in scikit-learn, the
+        classes are those of the train labels.
+    """
+    train_classes = [np.unique(y_train) for y_train in Y_train]
+    if method == 'ridge':
+        classes = train_classes[0]
+        if all(np.array_equal(c, classes) for c in train_classes):
+            return _ridge_predict(alpha, X_train, Y_train, X_test, classes,
+                                  locations)
+        # The labelings do not share their classes: fit them separately
+        return np.array([_ridge_predict(alpha, X_train,
+                                        y_train[np.newaxis], X_test,
+                                        classes, locations)[0]
+                         for y_train, classes
+                         in zip(Y_train, train_classes)])
+    if method == 'lda':
+        predict = _lda_predict
+    elif method == 'correlation':
+        predict = _correlation_predict
+    else:
+        raise ValueError("Unknown linear method '%s'" % method)
+    return np.array([predict(X_train, y_train, X_test, classes, locations)
+                     for y_train, classes in zip(Y_train, train_classes)])
+
+
+def _group_iter_linear_search_light(list_rows, method, alpha, X, y, folds,
+                                    score_func=None, batch_size=None):
+    """Function for grouped iterations of the vectorized search_light
+
+    Parameters
+    -----------
+    list_rows: array of array of integers
+        Indices of the voxels of each sphere to process
+
+    method: {'lda', 'ridge', 'correlation'}
+        The linear model to use
+
+    alpha: float
+        Regularization of the ridge model
+
+    X: array-like of shape at least 2D, or string
+        The data to fit, or the file in which it has been dumped by
+        _dump_shared.
+
+    y: array of shape (n_labelings, n_samples), or string
+        The labelings of the samples to predict, the true one first
+        followed by permutations, or the file in which they have been
+        dumped by _dump_shared.
+
+    folds: list of (train, test) pairs of arrays of integers
+        The cross-validation folds
+
+    score_func: callable, optional
+        callable taking as arguments the test target (y_test) and the
+        predicted target. By default, the accuracy is computed.
+
+    batch_size: integer, optional
+        Number of spheres scored at once. By default, it is set to bound
+        the memory used by a batch.
+
+    Returns
+    -------
+    par_scores: array of float of shape (n_labelings, n_spheres)
+        cross-validated score of each sphere, for each labeling
+
+    stats: dict
+        Timing of the batch, see _worker_stats
+    """
+    t0 = time.time()
+    X = _load_shared(X)
+    y = np.asarray(_load_shared(y))
+    n_spheres = len(list_rows)
+    par_scores = np.zeros((len(y), n_spheres))
+    if batch_size is None:
+        max_size = max([len(row) for row in list_rows] + [1])
+        # About 2**24 values per (sphere, sample, voxel) array
+        batch_size = max(1, 2 ** 24 // (X.shape[0] * max_size))
+    for start in range(0, n_spheres, batch_size):
+        rows = [np.asarray(row) for row in
+                list_rows[start:start + batch_size]]
+        # Spheres without any voxel of the mask cannot be scored
+        spheres = start + np.array([i for i, row in enumerate(rows)
+                                    if len(row)], dtype=np.int)
+        par_scores[:, start:start + len(rows)] = np.nan
+        par_scores[:, spheres] = 0
+        rows = [row for row in rows if len(row)]
+        if not rows:
+            continue
+        union, locations = _batch_locations(rows)
+        # Voxels of the batch, with a trailing column of zeros for padding
+        X_batch = np.zeros((X.shape[0], len(union) + 1))
+        X_batch[:, :-1] = X[:, union]
+        for train, test in folds:
+            y_pred = _linear_predict(method, alpha, X_batch[train],
+                                     y[:, train], X_batch[test], locations)
+            y_test = y[:, test]
+            if score_func is None:
+                fold_scores = np.mean(y_pred == y_test[:, np.newaxis],
+                                      axis=-1)
+            else:
+                fold_scores = [[score_func(this_test, this_pred)
+                                for this_pred in labeling_pred]
+                               for this_test, labeling_pred
+                               in zip(y_test, y_pred)]
+            par_scores[:, spheres] += fold_scores
+    par_scores /= len(folds)
+    return par_scores, _worker_stats(t0, n_spheres)
 
 
 ##############################################################################
@@ -181,10 +949,14 @@ class SearchLight(BaseEstimator):
         mask of the data that will be processed by searchlight
 
     radius: float, optional
-        radius of the searchlight sphere
+        radius of the searchlight sphere, in voxels if affine is None, in
+        the units of the affine (usually mm) otherwise
 
-    estimator: estimator object implementing 'fit'
-        The object to use to fit the data
+    estimator: estimator object implementing 'fit', or string
+        The object to use to fit the data. LDA and RidgeClassifier
+        instances, as well as the strings 'lda', 'ridge' and 'correlation'
+        (nearest class mean with correlation distance), are run by a
+        vectorized engine that scores many spheres at once.
 
     n_jobs: integer, optional. Default is -1.
         The number of CPUs to use to do the computation. -1 means
@@ -203,6 +975,36 @@ class SearchLight(BaseEstimator):
     verbose: integer, optional
         The verbosity level. Defaut is False
 
+    affine: 4x4 array, optional
+        Affine of the mask. If given, the radius is in world units and the
+        spheres account for anisotropic or oblique voxels.
+
+    checkpoint: string, optional
+        Folder in which the scores are saved during the fit, so that an
+        interrupted fit can be resumed. See search_light.
+
+    n_permutations: integer, optional
+        Number of permutations of y used to compute voxelwise p-values.
+        The permutations share the extraction of the spheres with the
+        true labels.
+
+    random_state: int or RandomState, optional
+        Pseudo number generator state used to permute y.
+
+    progress: callable or string, optional
+        Callable receiving progress reports during the fit, or file to
+        which they are appended as lines of JSON. See search_light.
+
+    stride: integer, optional
+        If larger than 1, only the centers whose coordinates are all
+        multiples of stride are computed, and the other scores are
+        interpolated from them: a preview of the map for a fraction of
+        the cost.
+
+    refine_threshold: float, optional
+        With a stride, the centers whose interpolated score is at least
+        refine_threshold are then computed at full resolution.
+
     Notes
     ------
     The searchlight [Kriegeskorte 06] is a widely used approach for the
@@ -224,7 +1026,9 @@ class SearchLight(BaseEstimator):
 
     def __init__(self, mask, process_mask=None, radius=2.,
                  estimator=LinearSVC(C=1), n_jobs=1, score_func=None, cv=None,
-                 verbose=0):
+                 verbose=0, affine=None, checkpoint=None, n_permutations=0,
+                 random_state=None, progress=None, stride=1,
+                 refine_threshold=None):
         self.mask = mask
         self.process_mask = process_mask
         self.radius = radius
@@ -233,6 +1037,13 @@ class SearchLight(BaseEstimator):
         self.score_func = score_func
         self.cv = cv
         self.verbose = verbose
+        self.affine = affine
+        self.checkpoint = checkpoint
+        self.n_permutations = n_permutations
+        self.random_state = random_state
+        self.progress = progress
+        self.stride = stride
+        self.refine_threshold = refine_threshold
 
     def fit(self, X, y):
         """Fit the search_light
@@ -246,23 +1057,96 @@ class SearchLight(BaseEstimator):
         Attributes
         ----------
         scores_: array-like of shape (number of rows in A)
-            search_light scores
+            search_light scores, NaN for the centers whose sphere does not
+            hold any voxel of the mask
+
+        pvalues_: 3D array
+            Permutation p-values of the scores, if n_permutations > 0.
+            Centers whose score is interpolated have a p-value of 1.
+
+        evaluated_: 3D boolean array
+            Centers whose score is computed, and not interpolated from
+            the strided preview.
+
+        adjacency_: scipy.sparse.csr_matrix
+            Voxels of the sphere around each process_mask voxel, see
+            sphere_adjacency
         """
         mask = self.mask
         process_mask = self.process_mask
         if process_mask is None:
             process_mask = mask
-        mask_indices = np.asarray(np.where(mask != 0)).T
-        process_mask_indices = np.asarray(np.where(process_mask != 0)).T
-        clf = neighbors.NearestNeighbors(radius=self.radius)
-        A = clf.fit(mask_indices).radius_neighbors_graph(process_mask_indices)
-        A = A.tolil()
+        # The sphere adjacency is reused across fits with the same masks
+        # radius and affine
+        adjacency_key = (self.radius, hash(mask), hash(process_mask),
+                         hash(self.affine))
+        if getattr(self, '_adjacency_key', None) != adjacency_key:
+            self.adjacency_ = sphere_adjacency(mask, process_mask,
+                                               self.radius, self.affine)
+            self._adjacency_key = adjacency_key
+        A = self.adjacency_
 
         # scores is an array of CV scores with same cardinality as process_mask
-        scores = search_light(X, y, self.estimator, A,
-                              self.score_func, self.cv, self.n_jobs,
-                              self.verbose)
+        n_centers = A.shape[0]
+        scores = np.zeros(n_centers)
+        pvalues = np.ones(n_centers)
+        if self.stride > 1:
+            # Coarse pass on a lattice of the centers
+            centers = np.array(np.where(process_mask))
+            evaluated = np.all(centers % self.stride == 0, axis=0)
+        else:
+            evaluated = np.ones(n_centers, dtype=np.bool)
+        self._search_light(X, y, A, evaluated, scores, pvalues, 'coarse')
+        if self.stride > 1:
+            scores_3D = np.zeros(process_mask.shape)
+            evaluated_3D = np.zeros(process_mask.shape, dtype=np.bool)
+            scores_3D[process_mask] = scores
+            evaluated_3D[process_mask] = evaluated
+            # Empty spheres, scored NaN, are not interpolated
+            filled, covered = _strided_fill(
+                scores_3D, evaluated_3D & np.isfinite(scores_3D),
+                self.stride)
+            scores = filled[process_mask]
+            # Centers too far from the lattice to be interpolated, and
+            # centers that pass the threshold, are computed
+            refine = np.logical_not(covered[process_mask])
+            if self.refine_threshold is not None:
+                refine |= scores >= self.refine_threshold
+            refine[evaluated] = False
+            if refine.any():
+                self._search_light(X, y, A, refine, scores, pvalues,
+                                   'refine')
+            evaluated |= refine
+            # Empty spheres have no score, whether evaluated or not
+            scores[np.diff(A.indptr) == 0] = np.nan
+
+        if self.n_permutations > 0:
+            pvalues_3D = np.ones(process_mask.shape)
+            pvalues_3D[process_mask] = pvalues
+            self.pvalues_ = pvalues_3D
         scores_3D = np.zeros(process_mask.shape)
         scores_3D[process_mask] = scores
         self.scores_ = scores_3D
+        evaluated_3D = np.zeros(process_mask.shape, dtype=np.bool)
+        evaluated_3D[process_mask] = evaluated
+        self.evaluated_ = evaluated_3D
         return self
+
+    def _search_light(self, X, y, A, centers, scores, pvalues, name):
+        """ Run search_light on the given centers (a boolean mask of the
+            rows of A), and store the results in scores and pvalues.
+        """
+        checkpoint = self.checkpoint
+        if checkpoint is not None and self.stride > 1:
+            # Each pass has its own checkpoint
+            checkpoint = os.path.join(checkpoint, name)
+        results = search_light(X, y, self.estimator, A[np.where(centers)[0]],
+                               self.score_func, self.cv, self.n_jobs,
+                               self.verbose, checkpoint=checkpoint,
+                               n_permutations=self.n_permutations,
+                               random_state=self.random_state,
+                               progress=self.progress)
+        if self.n_permutations > 0:
+            scores[centers], pvalues[centers] = results
+        else:
+            scores[centers] = results
@@ -62,3 +62,264 @@ sl = searchlight.SearchLight(mask=mask, process_mask=mask, radius=2,
 sl.fit(data_masked, cond)
 assert_equal(np.where(sl.scores_ == 1)[0].size, 33)
 assert_equal(sl.scores_[2, 2, 2], 1.)
+
+# Vectorized engine for linear models: same scores as cross_val_score
+from scipy import sparse
+from sklearn.cross_validation import cross_val_score
+from sklearn.lda import LDA
+from sklearn.linear_model import RidgeClassifier
+
+X = rand.randn(40, 20)
+y = np.arange(40) % 3
+X[y == 1, :4] += 1
+A = sparse.lil_matrix((20, 20))
+for i in range(20):
+    A[i, max(0, i - 2):i + 3] = 1
+cv3 = KFold(y.size, k=4)
+for estimator in [LDA(), RidgeClassifier(alpha=.5)]:
+    scores = searchlight.search_light(X, y, estimator, A, cv=cv3, n_jobs=1)
+    expected = [np.mean(cross_val_score(estimator, X[:, row], y, cv=cv3))
+                for row in A.rows]
+    np.testing.assert_array_almost_equal(scores, expected)
+
+# A class missing from a training fold is not predicted, as in
+# cross_val_score
+y_missing = y.copy()
+y_missing[10:][y_missing[10:] == 2] = 0
+for estimator in [LDA(), RidgeClassifier(alpha=.5)]:
+    scores = searchlight.search_light(X, y_missing, estimator, A, cv=cv3,
+                                      n_jobs=1)
+    expected = [np.mean(cross_val_score(estimator, X[:, row], y_missing,
+                                        cv=cv3))
+                for row in A.rows]
+    np.testing.assert_array_almost_equal(scores, expected)
+
+sl = searchlight.SearchLight(mask=mask, process_mask=mask, radius=1,
+                             estimator='correlation', n_jobs=n_jobs, cv=cv)
+sl.fit(data_masked, cond)
+assert_equal(sl.scores_[2, 2, 2], 1.)
+
+# Small batches, dispatched by decreasing cost, are reassembled in order
+group_iter = searchlight.GroupIterator(10, batch_size=3,
+                                       costs=np.arange(10))
+batches = list(group_iter)
+assert_equal([list(b) for b in batches], [[8, 9], [6, 7], [3, 4, 5],
+                                          [0, 1, 2]])
+scores = searchlight.search_light(X, y, LDA(), A, cv=cv3, n_jobs=1,
+                                  batch_size=3)
+np.testing.assert_array_almost_equal(
+    scores, searchlight.search_light(X, y, LDA(), A, cv=cv3, n_jobs=1,
+                                     largest_first=False))
+
+# The generic engine, fitting on pre-sliced folds, matches cross_val_score
+from sklearn.svm import LinearSVC
+estimator = LinearSVC(C=.1)
+scores = searchlight.search_light(X, y, estimator, A, cv=cv3, n_jobs=1)
+expected = [np.mean(cross_val_score(estimator, X[:, row], y, cv=cv3))
+            for row in A.rows]
+np.testing.assert_array_almost_equal(scores, expected)
+scores = searchlight.search_light(X, y, estimator, A, cv=cv3, n_jobs=1,
+                                  score_func=precision_score)
+expected = [np.mean(cross_val_score(estimator, X[:, row], y, cv=cv3,
+                                    score_func=precision_score))
+            for row in A.rows]
+np.testing.assert_array_almost_equal(scores, expected)
+# Regressors get the default, unstratified, folds of cross_val_score
+from sklearn.linear_model import Ridge
+y_continuous = rand.randn(40)
+scores = searchlight.search_light(X, y_continuous, Ridge(), A, n_jobs=1)
+expected = [np.mean(cross_val_score(Ridge(), X[:, row], y_continuous))
+            for row in A.rows]
+np.testing.assert_array_almost_equal(scores, expected)
+
+# Centers of process_mask whose sphere holds no voxel of the mask are
+# scored NaN by both engines, even in batches of empty spheres only
+small_mask = np.zeros((5, 5, 5), np.bool)
+small_mask[:2] = True
+process_mask = np.zeros((5, 5, 5), np.bool)
+process_mask[0, 0, 0] = process_mask[4, 4, 4] = process_mask[4, 0, 0] = True
+for estimator in [LinearSVC(C=.1), LDA()]:
+    sl = searchlight.SearchLight(mask=small_mask, process_mask=process_mask,
+                                 radius=1, estimator=estimator,
+                                 n_jobs=n_jobs, cv=cv, n_permutations=2)
+    sl.fit(data[:, small_mask], cond)
+    assert np.isfinite(sl.scores_[0, 0, 0])
+    assert np.isnan(sl.scores_[4, 4, 4])
+    assert np.isnan(sl.scores_[4, 0, 0])
+    assert np.isnan(sl.pvalues_[4, 4, 4])
+# Empty spheres mixed with others in a batch
+A_empty = A.copy()
+A_empty[::2] = 0
+for estimator in [LinearSVC(C=.1), LDA()]:
+    scores = searchlight.search_light(X, y, estimator, A_empty, cv=cv3,
+                                      n_jobs=1, batch_size=20)
+    assert np.all(np.isnan(scores[::2]))
+    np.testing.assert_array_almost_equal(
+        scores[1::2], searchlight.search_light(X, y, estimator, A[1::2],
+                                               cv=cv3, n_jobs=1))
+
+# Data shared with the workers is memory-mapped
+import os
+import shutil
+import tempfile
+temp_dir = tempfile.mkdtemp()
+try:
+    shared = searchlight._dump_shared(X, os.path.join(temp_dir, 'X.npy'))
+    X_shared = searchlight._load_shared(shared)
+    assert isinstance(X_shared, np.memmap)
+    np.testing.assert_array_equal(X_shared, X)
+    assert searchlight._load_shared(X) is X
+finally:
+    shutil.rmtree(temp_dir)
+
+# Sphere adjacency: same spheres as a radius query in voxel space
+from sklearn import neighbors
+mask = rand.rand(6, 7, 8) > .3
+process_mask = np.logical_and(mask, rand.rand(6, 7, 8) > .5)
+for radius in [0.5, 1, 1.5, 2.5]:
+    A = searchlight.sphere_adjacency(mask, process_mask, radius)
+    assert_equal(A.indices.dtype, np.int32)
+    clf = neighbors.NearestNeighbors(radius=radius)
+    clf.fit(np.asarray(np.where(mask)).T)
+    A_ref = clf.radius_neighbors_graph(np.asarray(np.where(process_mask)).T)
+    np.testing.assert_array_equal(A.toarray(), A_ref.toarray())
+
+# Sphere adjacency with an affine: same spheres as a radius query in world
+# space, for anisotropic and oblique voxels
+affine = np.diag([2., 1., 3., 1.])
+oblique_affine = affine.copy()
+oblique_affine[0, 1] = .5
+oblique_affine[2, 0] = -.7
+for this_affine in [affine, oblique_affine]:
+    A = searchlight.sphere_adjacency(mask, process_mask, 3.5,
+                                     affine=this_affine)
+    clf = neighbors.NearestNeighbors(radius=3.5)
+    clf.fit(np.dot(this_affine[:3, :3], np.where(mask)).T)
+    A_ref = clf.radius_neighbors_graph(
+        np.dot(this_affine[:3, :3], np.where(process_mask)).T)
+    np.testing.assert_array_equal(A.toarray(), A_ref.toarray())
+
+# Checkpointed runs save the scores, and resume on the remaining voxels
+from nose.tools import assert_raises
+A = sparse.lil_matrix((20, 20))
+for i in range(20):
+    A[i, max(0, i - 2):i + 3] = 1
+temp_dir = tempfile.mkdtemp()
+try:
+    checkpoint = os.path.join(temp_dir, 'checkpoint')
+    expected = searchlight.search_light(X, y, LDA(), A, cv=cv3, n_jobs=1)
+    scores = searchlight.search_light(X, y, LDA(), A, cv=cv3, n_jobs=1,
+                                      checkpoint=checkpoint)
+    np.testing.assert_array_almost_equal(scores, expected)
+    # Simulate an interrupted run: voxels flagged as done are not computed
+    # again
+    done = np.load(os.path.join(checkpoint, 'done.npy'), mmap_mode='r+')
+    saved_scores = np.load(os.path.join(checkpoint, 'scores.npy'),
+                           mmap_mode='r+')
+    done[10:] = False
+    saved_scores[:, :5] = -1
+    done.flush()
+    saved_scores.flush()
+    del done, saved_scores
+    scores = searchlight.search_light(X, y, LDA(), A, cv=cv3, n_jobs=1,
+                                      batch_size=3, checkpoint=checkpoint)
+    np.testing.assert_array_equal(scores[:5], -1)
+    np.testing.assert_array_almost_equal(scores[5:], expected[5:])
+    assert_raises(ValueError, searchlight.search_light, X, y, LDA(),
+                  A[:10], cv=cv3, n_jobs=1, checkpoint=checkpoint)
+    # The checkpoint is tied to the data, the estimator and the scoring
+    assert_raises(ValueError, searchlight.search_light, X + 1, y, LDA(),
+                  A, cv=cv3, n_jobs=1, checkpoint=checkpoint)
+    assert_raises(ValueError, searchlight.search_light, X, y,
+                  LinearSVC(C=.1), A, cv=cv3, n_jobs=1,
+                  checkpoint=checkpoint)
+    assert_raises(ValueError, searchlight.search_light, X, y, LDA(), A,
+                  cv=cv3, n_jobs=1, score_func=precision_score,
+                  checkpoint=checkpoint)
+    # A finished checkpoint is returned as is
+    np.testing.assert_array_equal(
+        searchlight.search_light(X, y, LDA(), A, cv=cv3, n_jobs=1,
+                                 checkpoint=checkpoint), scores)
+    # Resumed permutations are those of the interrupted run
+    checkpoint = os.path.join(temp_dir, 'permutations')
+    expected = searchlight.search_light(X, y, LDA(), A, cv=cv3, n_jobs=1,
+                                        n_permutations=3,
+                                        checkpoint=checkpoint)
+    done = np.load(os.path.join(checkpoint, 'done.npy'), mmap_mode='r+')
+    done[10:] = False
+    done.flush()
+    del done
+    resumed = searchlight.search_light(X, y, LDA(), A, cv=cv3, n_jobs=1,
+                                       n_permutations=3,
+                                       checkpoint=checkpoint)
+    for result, expected_result in zip(resumed, expected):
+        np.testing.assert_array_almost_equal(result, expected_result)
+finally:
+    shutil.rmtree(temp_dir)
+assert_equal(list(searchlight.GroupIterator(0, batch_size=3)), [])
+
+# Permutations: same null scores as separate runs on permuted labels
+for estimator in [LDA(), RidgeClassifier(alpha=.5), 'correlation',
+                  LinearSVC(C=.1)]:
+    scores, pvalues = searchlight.search_light(X, y, estimator, A, cv=cv3,
+                                               n_jobs=1, n_permutations=4,
+                                               random_state=0)
+    expected = searchlight.search_light(X, y, estimator, A, cv=cv3,
+                                        n_jobs=1)
+    np.testing.assert_array_almost_equal(scores, expected)
+    permutation_rng = np.random.RandomState(0)
+    null_scores = [searchlight.search_light(X, permutation_rng.permutation(y),
+                                            estimator, A, cv=cv3, n_jobs=1)
+                   for _ in range(4)]
+    expected_pvalues = (1. + (np.array(null_scores) >= scores).sum(axis=0)
+                        ) / 5.
+    np.testing.assert_array_almost_equal(pvalues, expected_pvalues)
+
+# Progress reports, passed to a callback or appended to a JSON log
+import json
+reports = []
+temp_dir = tempfile.mkdtemp()
+try:
+    log = os.path.join(temp_dir, 'progress.json')
+    for progress in [reports.append, log]:
+        searchlight.search_light(X, y, LinearSVC(C=.1), A, cv=cv3, n_jobs=1,
+                                 batch_size=7, progress=progress)
+    with open(log) as f:
+        logged = [json.loads(line) for line in f]
+finally:
+    shutil.rmtree(temp_dir)
+assert_equal(len(reports), 3)
+assert_equal(len(logged), 3)
+assert_equal([r['n_done'] for r in reports], [7, 14, 20])
+assert_equal(reports[-1]['n_voxels'], 20)
+assert_equal(sorted(reports[-1]['sphere_sizes']), [(3, 2), (4, 2), (5, 16)])
+assert_equal(logged[-1]['sphere_sizes'], [[3, 2], [4, 2], [5, 16]])
+assert_equal(reports[-1]['worker_utilization'].keys(), [str(os.getpid())])
+assert reports[-1]['mean_fit_time'] > 0
+
+# Strided preview: linear maps are interpolated exactly between lattice
+# points
+ramp = np.sum(np.indices((7, 7, 7)), axis=0).astype(np.float)
+lattice = np.zeros(ramp.shape, dtype=np.bool)
+lattice[::3, ::3, ::3] = True
+filled, covered = searchlight._strided_fill(ramp, lattice, 3)
+assert covered.all()
+np.testing.assert_array_almost_equal(filled, ramp)
+
+# Strided preview: computed centers match the full resolution map, others
+# are interpolated under the refinement threshold
+mask = np.ones((5, 5, 5), np.bool)
+sl = searchlight.SearchLight(mask=mask, radius=1, n_jobs=n_jobs,
+                             score_func=score_func, cv=cv)
+sl.fit(data_masked, cond)
+sl_strided = searchlight.SearchLight(mask=mask, radius=1, n_jobs=n_jobs,
+                                     score_func=score_func, cv=cv, stride=2,
+                                     refine_threshold=.6)
+sl_strided.fit(data_masked, cond)
+evaluated = sl_strided.evaluated_
+assert evaluated[::2, ::2, ::2].all()
+assert not evaluated.all()
+np.testing.assert_array_equal(sl_strided.scores_[evaluated],
+                              sl.scores_[evaluated])
+assert np.all(sl_strided.scores_[~evaluated] < .6)
+assert_equal(sl_strided.scores_[2, 2, 2], 1.)
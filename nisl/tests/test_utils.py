@@ -6,16 +6,20 @@ Test the utils module
 
 
 import os
+import shutil
 import tempfile
+import warnings
 
 import nose
-from nose.tools import assert_raises, assert_equal
+from nose.tools import assert_raises, assert_equal, assert_true
 
 import numpy as np
 
 import nibabel
 from nibabel import Nifti1Image
 
+from sklearn.externals.joblib import Memory
+
 from .. import utils
 
 
@@ -102,3 +106,96 @@ def test_concat_niimgs():
     finally:
         _remove_if_exists(tmpimg1)
         _remove_if_exists(tmpimg2)
+
+
+class CacheMixinTest(utils.CacheMixin):
+
+    def __init__(self, memory, memory_level=1, memory_mmap_mode=None,
+                 memory_max_bytes=None, memory_ram_max_bytes=None):
+        self.memory = memory
+        self.memory_level = memory_level
+        self.memory_mmap_mode = memory_mmap_mode
+        self.memory_max_bytes = memory_max_bytes
+        self.memory_ram_max_bytes = memory_ram_max_bytes
+
+
+def _cached_ones(n):
+    return np.ones(n)
+
+
+def _cached_double(x):
+    return 2 * x
+
+
+def test_cache_mixin():
+    cachedir = tempfile.mkdtemp()
+    try:
+        # 2 arrays of 1000 floats fit in the cache, not 3
+        cached = CacheMixinTest(cachedir, memory_mmap_mode='r',
+                                memory_max_bytes=20000)
+        func = cached._cache(_cached_ones)
+        for n in [1000, 1001, 1000, 1002, 1003, 1000]:
+            out = func(n)
+            assert_equal(out.shape, (n, ))
+        # 1000 is evicted when 1003 is computed
+        assert_equal(cached.cache_info(),
+                     {'_cached_ones': {'hits': 1, 'ram_hits': 0,
+                                       'misses': 5}})
+        # Arrays are memory-mapped when loaded from the cache
+        out = func(1003)
+        assert_true(isinstance(out, np.memmap))
+        assert_equal(cached.cache_info()['_cached_ones']['hits'], 2)
+        assert_true(len(utils._cache_entries(cachedir)) <= 2)
+        # The running total of the cache size is kept up to date
+        joblib_dir = os.path.join(cachedir, 'joblib')
+        assert_equal(utils._cache_sizes[joblib_dir],
+                     sum(size for _, size, _
+                         in utils._cache_entries(joblib_dir)))
+    finally:
+        shutil.rmtree(cachedir, ignore_errors=True)
+
+
+def test_cache_mixin_ram():
+    cachedir = tempfile.mkdtemp()
+    try:
+        for memory in [Memory(cachedir=None), cachedir]:
+            utils._ram_caches.clear()
+            # 2 arrays of 1000 floats fit in memory, not 3
+            cached = CacheMixinTest(memory, memory_ram_max_bytes=20000)
+            func = cached._cache(_cached_ones)
+            for n in [1000, 1001, 1000, 1002, 1003, 1001]:
+                out = func(n)
+                assert_equal(out.shape, (n, ))
+            stats = cached.cache_info()['_cached_ones']
+            assert_equal(stats['ram_hits'], 1)
+            assert_equal(stats['hits'] + stats['misses'], 5)
+            # The computed result is returned unchanged, a read-only copy
+            # is kept in memory
+            out[0] = 2
+            cached_out = func(1001)
+            assert_equal(cached_out[0], 1)
+            assert_raises(ValueError, cached_out.__setitem__, 0, 2)
+            assert_true(func(1001) is cached_out)
+            # A smaller budget does not shrink the tier of other estimators
+            small = CacheMixinTest(memory, memory_ram_max_bytes=10000)
+            small._cache(_cached_ones)(1002)
+            assert_equal(utils._ram_caches[20000].size, 8 * (1003 + 1001))
+            assert_equal(utils._ram_caches[10000].size, 8 * 1002)
+            # Large arrays are identified by their identity in memory
+            double = cached._cache(_cached_double)
+            x = np.arange(2000.)
+            double(x)
+            double(x)
+            double(x.copy())
+            stats = cached.cache_info()['_cached_double']
+            assert_equal(stats['ram_hits'], 1)
+            assert_equal(stats['hits'] + stats['misses'], 2)
+        # Without caching, the in-memory tier is not used
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            CacheMixinTest(Memory(cachedir=None), memory_level=0,
+                           memory_ram_max_bytes=20000)._cache(_cached_ones)
+        assert_equal(len(caught), 1)
+    finally:
+        utils._ram_caches.clear()
+        shutil.rmtree(cachedir, ignore_errors=True)
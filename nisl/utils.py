@@ -6,12 +6,38 @@ Validation and conversion utilities.
 
 
 import collections
+import os
+import shutil
 import warnings
+import weakref
 
 import nibabel
 import numpy as np
 from scipy import ndimage
-from sklearn.externals.joblib import Memory
+from sklearn.externals.joblib import Memory, hash
+from sklearn.externals.joblib.func_inspect import filter_args, get_func_name
+
+
+###############################################################################
+# Sharing arrays with worker processes
+###############################################################################
+
+def _dump_shared(array, filename):
+    """ Save an array to be memory-mapped by worker processes.
+
+    Returns the filename, that _load_shared turns back into an array.
+    """
+    np.save(filename, np.asarray(array))
+    return filename
+
+
+def _load_shared(array):
+    """ Memory-map an array saved by _dump_shared. Arrays are returned
+        as is.
+    """
+    if isinstance(array, basestring):
+        return np.load(array, mmap_mode='r')
+    return array
 
 
 ###############################################################################
@@ -242,6 +268,277 @@ def check_niimgs(niimgs, accept_3d=False):
 ### Caching
 ###############################################################################
 
+# Approximate size of the cache directories, in bytes, updated as results
+# are added so that a directory is walked only when its budget may be
+# exceeded. Results added or evicted by other processes are only accounted
+# for at the next walk.
+_cache_sizes = dict()
+
+
+def _files_size(dirpath, filenames):
+    """ Total size of the given files of a directory.
+    """
+    size = 0
+    for filename in filenames:
+        try:
+            size += os.path.getsize(os.path.join(dirpath, filename))
+        except OSError:
+            # Concurrent eviction by another process
+            pass
+    return size
+
+
+def _cache_entries(cachedir):
+    """ List the results stored in a joblib cache directory.
+
+    Returns a list of (last_access, size, output_dir) tuples, one per
+    cached function call. The last access time is the modification time
+    of the output directory, which is refreshed on every cache hit.
+    """
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(cachedir):
+        if not 'output.pkl' in filenames:
+            continue
+        entries.append((os.path.getmtime(dirpath),
+                        _files_size(dirpath, filenames), dirpath))
+        # Cached results do not have subdirectories
+        del dirnames[:]
+    return entries
+
+
+def reduce_cache_size(cachedir, max_bytes, keep=()):
+    """ Evict least recently used results from a joblib cache directory.
+
+    Parameters
+    ----------
+    cachedir: string
+        Path of the joblib cache directory (Memory.cachedir).
+
+    max_bytes: integer
+        Maximum number of bytes that the cached results may occupy on disk.
+
+    keep: list of strings, optional
+        Output directories that must not be evicted, e.g. the result that
+        has just been computed.
+
+    Returns
+    -------
+    evicted: list of strings
+        Output directories that have been removed.
+    """
+    entries = _cache_entries(cachedir)
+    total_size = sum(size for _, size, _ in entries)
+    evicted = []
+    # Oldest access first
+    for _, size, output_dir in sorted(entries):
+        if total_size <= max_bytes:
+            break
+        if output_dir in keep:
+            continue
+        shutil.rmtree(output_dir, ignore_errors=True)
+        total_size -= size
+        evicted.append(output_dir)
+    _cache_sizes[cachedir] = total_size
+    return evicted
+
+
+def _add_cache_entry(cachedir, output_dir, max_bytes):
+    """ Account for a result added to a joblib cache directory, and evict
+        least recently used results if the directory may exceed max_bytes.
+
+        The directory is walked by reduce_cache_size only the first time,
+        and when the running total of its size exceeds max_bytes.
+    """
+    size = _cache_sizes.get(cachedir)
+    if size is not None:
+        try:
+            size += _files_size(output_dir, os.listdir(output_dir))
+        except OSError:
+            pass
+        _cache_sizes[cachedir] = size
+        if size <= max_bytes:
+            return []
+    return reduce_cache_size(cachedir, max_bytes, keep=[output_dir])
+
+
+def _nbytes(obj):
+    """ Rough estimate of the memory used by an object returned by a
+        cached function.
+    """
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if is_a_niimg(obj):
+        return _nbytes(obj.get_data())
+    if isinstance(obj, (tuple, list)):
+        return sum(_nbytes(o) for o in obj)
+    return 0
+
+
+def _readonly_copy(obj):
+    """ Copy of the arrays of obj protected from in-place modifications,
+        so that the result kept in memory is independent of the one
+        returned to the caller. Memory-mapped arrays are not copied.
+    """
+    if isinstance(obj, np.ndarray) and not isinstance(obj, np.memmap):
+        obj = obj.copy()
+        obj.flags.writeable = False
+    elif isinstance(obj, (tuple, list)):
+        obj = type(obj)(_readonly_copy(o) for o in obj)
+    return obj
+
+
+# Arrays up to this size are identified by their content in the keys of
+# the in-memory tier, larger ones by their identity
+_RAM_KEY_MAX_HASHED_BYTES = 10000
+
+
+def _ram_key(obj, refs):
+    """ Cheap key of a function argument for the in-memory tier.
+
+    Unlike a joblib hash, the key does not depend on the content of large
+    objects: filenames are identified by their modification time, and
+    images or large arrays by their identity. A weak reference to the
+    objects identified by their identity is appended to refs, so that a
+    key is not matched by a new object reusing the identity of a deleted
+    one.
+    """
+    if isinstance(obj, basestring):
+        if os.path.isfile(obj):
+            return (obj, os.path.getmtime(obj))
+        return obj
+    if obj is None or isinstance(obj, (bool, int, long, float, complex)):
+        return obj
+    if isinstance(obj, (tuple, list)):
+        return (type(obj).__name__, ) + tuple(_ram_key(o, refs)
+                                              for o in obj)
+    if isinstance(obj, dict):
+        return ('dict', ) + tuple(sorted((k, _ram_key(v, refs))
+                                         for k, v in obj.items()))
+    if (isinstance(obj, np.ndarray)
+            and obj.nbytes <= _RAM_KEY_MAX_HASHED_BYTES):
+        return hash(obj)
+    try:
+        refs.append(weakref.ref(obj))
+    except TypeError:
+        return hash(obj)
+    return ('id', id(obj))
+
+
+class _RAMCache(object):
+    """ In-process least recently used store of function outputs, bounded
+        in bytes.
+    """
+
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        """ Return (True, value) if key is in the cache, (False, None)
+            otherwise.
+        """
+        if not key in self._entries:
+            return False, None
+        value, nbytes, refs = self._entries.pop(key)
+        if any(ref() is None for ref in refs):
+            # An object of the key has been deleted: its identity may
+            # have been reused by another one
+            self.size -= nbytes
+            return False, None
+        # Move the entry to the most recently used position
+        self._entries[key] = (value, nbytes, refs)
+        return True, value
+
+    def put(self, key, value, refs=()):
+        """ Store value under key. refs are weak references to the
+            objects identified by their identity in the key.
+        """
+        nbytes = _nbytes(value)
+        if nbytes > self.max_bytes:
+            return
+        if key in self._entries:
+            self.size -= self._entries.pop(key)[1]
+        self._entries[key] = (_readonly_copy(value), nbytes, refs)
+        self.size += nbytes
+        while self.size > self.max_bytes:
+            _, (_, old_nbytes, _) = self._entries.popitem(last=False)
+            self.size -= old_nbytes
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+
+# The in-memory tiers are shared by all the estimators of the process, so
+# that they survive parameter changes and estimator cloning. There is one
+# tier per value of memory_ram_max_bytes, each bounded by its own budget.
+_ram_caches = dict()
+
+
+class _CachedFunc(object):
+    """ Wraps a function with an optional in-memory tier in front of an
+        optional joblib disk cache, counts cache hits and misses and bounds
+        the size of the cache directory.
+    """
+
+    def __init__(self, func, memorized_func=None, stats=None,
+                 max_bytes=None, ram_cache=None, ignore=None):
+        self.func = func
+        self.memorized_func = memorized_func
+        self.stats = stats
+        self.max_bytes = max_bytes
+        self.ram_cache = ram_cache
+        self.ignore = ignore
+
+    def __call__(self, *args, **kwargs):
+        memorized_func = self.memorized_func
+        # The in-memory tier uses a cheap key, that does not hash the
+        # content of the arguments
+        if self.ram_cache is not None:
+            refs = []
+            module, name = get_func_name(self.func)
+            ram_key = ('.'.join(module), name,
+                       _ram_key(filter_args(self.func, self.ignore,
+                                            args, kwargs), refs))
+            found, output = self.ram_cache.get(ram_key)
+            if found:
+                self.stats['ram_hits'] += 1
+                return output
+
+        if memorized_func is None:
+            self.stats['misses'] += 1
+            output = self.func(*args, **kwargs)
+        else:
+            # Hashing the arguments is costly, so we do it only once and
+            # replicate the logic of MemorizedFunc.__call__
+            output_dir, _ = memorized_func.get_output_dir(*args, **kwargs)
+            output = None
+            if (memorized_func._check_previous_func_code(stacklevel=3)
+                    and os.path.exists(os.path.join(output_dir,
+                                                    'output.pkl'))):
+                try:
+                    output = memorized_func.load_output(output_dir)
+                    # Refresh the access time used for LRU eviction
+                    os.utime(output_dir, None)
+                    self.stats['hits'] += 1
+                except Exception:
+                    shutil.rmtree(output_dir, ignore_errors=True)
+                    output = None
+            if output is None:
+                self.stats['misses'] += 1
+                output = self.func(*args, **kwargs)
+                memorized_func._persist_output(output, output_dir)
+                memorized_func._persist_input(output_dir, *args, **kwargs)
+                if self.max_bytes is not None:
+                    _add_cache_entry(memorized_func.cachedir, output_dir,
+                                     self.max_bytes)
+
+        if self.ram_cache is not None:
+            self.ram_cache.put(ram_key, output, refs)
+        return output
+
+
 class CacheMixin(object):
     """Mixin to add caching to a class.
 
@@ -252,6 +549,17 @@ class CacheMixin(object):
     defined by this class. Caching is performed only if the user-specified
     cache level (self._memory_level) is greater than the value given as a
     parameter to self._cache(). See _cache() documentation for details.
+
+    Two optional attributes tune the disk cache: memory_mmap_mode is the
+    joblib mmap_mode used to load cached arrays (e.g. 'r' to memory-map
+    them instead of reading them in full) and memory_max_bytes bounds the
+    size of the cache directory, least recently used results being evicted
+    first. A third one, memory_ram_max_bytes, enables an in-process tier in
+    front of the disk cache, holding read-only copies of the most recently
+    used results up to the given number of bytes. The tier is only used by
+    the functions whose output is cached, i.e. whose level is at most
+    memory_level. Hits and misses of each wrapped function are reported by
+    cache_info().
     """
 
     def _cache(self, func, memory_level=1, **kwargs):
@@ -285,6 +593,12 @@ class CacheMixin(object):
             self.memory_level = 0
         if not hasattr(self, "memory"):
             self.memory = Memory(cachedir=None)
+        if not hasattr(self, "memory_mmap_mode"):
+            self.memory_mmap_mode = None
+        if not hasattr(self, "memory_max_bytes"):
+            self.memory_max_bytes = None
+        if not hasattr(self, "memory_ram_max_bytes"):
+            self.memory_ram_max_bytes = None
 
         # If cache level is 0 but a memory object has been provided, set
         # memory_level to 1 with a warning.
@@ -295,6 +609,10 @@ class CacheMixin(object):
                               "a Memory object has been provided. "
                               "Setting memory_level to 1.")
                 self.memory_level = 1
+        if self.memory_level == 0 and self.memory_ram_max_bytes:
+            warnings.warn("memory_ram_max_bytes is set but memory_level is "
+                          "0: the in-memory cache is not used. Set "
+                          "memory_level to enable it.")
 
         if self.memory_level < memory_level:
             mem = Memory(cachedir=None)
@@ -306,9 +624,48 @@ class CacheMixin(object):
             if not isinstance(memory, Memory):
                 raise TypeError("'memory' argument must be a string or a "
                                 "joblib.Memory object.")
+            ram_cache = None
+            if self.memory_ram_max_bytes:
+                ram_cache = _ram_caches.get(self.memory_ram_max_bytes)
+                if ram_cache is None:
+                    ram_cache = _RAMCache(self.memory_ram_max_bytes)
+                    _ram_caches[self.memory_ram_max_bytes] = ram_cache
             if memory.cachedir is None:
-                warnings.warn("Caching has been enabled (memory_level = %d) but no"
-                              " Memory object or path has been provided (parameter"
-                              " memory). Caching deactivated for function %s." %
-                              (self.memory_level, func.func_name))
-            return memory.cache(func, **kwargs)
+                if ram_cache is None:
+                    warnings.warn("Caching has been enabled (memory_level = %d)"
+                                  " but no Memory object or path has been"
+                                  " provided (parameter memory). Caching"
+                                  " deactivated for function %s." %
+                                  (self.memory_level, func.func_name))
+                    return memory.cache(func, **kwargs)
+                memorized_func = None
+            else:
+                if self.memory_mmap_mode is not None:
+                    if memory.compress:
+                        warnings.warn("Compressed results cannot be "
+                                      "memmapped. Function %s results will "
+                                      "be loaded in memory." % func.func_name)
+                    kwargs.setdefault('mmap_mode', self.memory_mmap_mode)
+                memorized_func = memory.cache(func, **kwargs)
+            if not hasattr(self, "_cache_stats"):
+                self._cache_stats = dict()
+            stats = self._cache_stats.setdefault(
+                func.func_name, dict(hits=0, ram_hits=0, misses=0))
+            return _CachedFunc(func, memorized_func, stats,
+                               max_bytes=self.memory_max_bytes,
+                               ram_cache=ram_cache,
+                               ignore=kwargs.get('ignore', []))
+
+    def cache_info(self):
+        """ Return the cache statistics of the functions wrapped by _cache()
+
+        Returns
+        -------
+        stats: dict
+            For each function name, a dictionary giving the number of
+            'hits' of the disk cache, of 'ram_hits' of the in-memory tier and
+            of 'misses' (calls that have been computed).
+        """
+        stats = getattr(self, "_cache_stats", dict())
+        return dict((name, func_stats.copy())
+                    for name, func_stats in stats.items())